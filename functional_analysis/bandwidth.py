@@ -0,0 +1,80 @@
+'''
+Vectorized half-max bandwidth of every pixel's frequency tuning curve.
+
+get_bandwidth (widefield_bandwidth notebook) called count_above_half_max for every pixel, which walked left and right from
+the peak with Python while loops.  Here the per-frequency maps are stacked once (N_freqs x N_pixels x N_pixels) and the
+contiguous run of frequencies at or above half the peak, around the peak, is found for all pixels at once: the run ends at
+the nearest below-half-max frequency on either side of the argmax, so it is just a masked max / min of the frequency index.
+
+As in count_above_half_max, a pixel with no response above response_threshold (1 z-score) has bandwidth 0, and the peak
+is the first maximum.  Next to the count of frequencies, the bandwidth is given in octaves from the actual frequency list:
+each frequency stands for the band between the geometric midpoints to its neighbours (the end frequencies get half their
+neighbour's spacing on the outside), and the run spans from the lower edge of its first frequency to the upper edge of its
+last.  For evenly log-spaced frequencies this is simply count x spacing in octaves.
+'''
+
+from collections import namedtuple
+
+import numpy as np
+
+from functional_analysis.best_frequency import stack_maps
+
+RESPONSE_THRESHOLD = 1 # a pixel needs a response above this to get a bandwidth at all
+
+Bandwidth = namedtuple('Bandwidth', ['count', 'octaves', 'peak'])
+
+
+def frequency_edges(freqs):
+    '''
+    Band edges (Hz) of a sorted list of stimulus frequencies, at the geometric midpoints between neighbours.
+    @Return: len(freqs) + 1 edges.
+    '''
+    log_f = np.log2(np.asarray(freqs, dtype=np.float64))
+    if len(log_f) == 1:
+        return 2 ** np.array([log_f[0] - 0.5, log_f[0] + 0.5]) # no spacing to go by - call it one octave wide
+    mids = (log_f[1:] + log_f[:-1]) / 2
+    first = log_f[0] - (mids[0] - log_f[0])
+    last = log_f[-1] + (log_f[-1] - mids[-1])
+    return 2 ** np.concatenate(([first], mids, [last]))
+
+
+def half_max_bandwidth(maps, freqs=None, response_threshold=RESPONSE_THRESHOLD):
+    '''
+    Width of the above-half-max run of frequencies around each pixel's peak.
+    @Param maps: dict of per-frequency maps (e.g. max_dict, keys are frequencies in Hz) or a N_freqs x N_pixels x N_pixels
+    array, frequencies in ascending order.
+    @Param freqs: the stimulus frequencies in Hz, defaults to the dict keys.  Needed for octaves when maps is an array.
+    @Return: Bandwidth(count, octaves, peak), each N_pixels x N_pixels: the number of frequencies in the run (0 for
+    unresponsive pixels), the run's width in octaves (0 for unresponsive pixels, NaN if no frequencies are known) and
+    the index of the peak frequency.
+    '''
+    if isinstance(maps, dict):
+        keys, maps = stack_maps(maps)
+        freqs = keys if freqs is None else freqs
+    maps = np.asarray(maps, dtype=np.float64)
+    n_freqs = len(maps)
+
+    peak = np.argmax(maps, axis=0)
+    peak_value = np.take_along_axis(maps, peak[np.newaxis], axis=0)[0]
+    below = ~(maps >= peak_value / 2) # NaNs count as below
+    index = np.arange(n_freqs).reshape((n_freqs,) + (1,) * (maps.ndim - 1))
+
+    # nearest below-half-max frequency on each side of the peak (-1 / n_freqs if the run reaches the end)
+    left = np.where(below & (index < peak), index, -1).max(axis=0)
+    right = np.where(below & (index > peak), index, n_freqs).min(axis=0)
+    responsive = (maps > response_threshold).any(axis=0)
+    count = np.where(responsive, right - left - 1, 0)
+
+    if freqs is None:
+        octaves = np.full(count.shape, np.nan)
+    else:
+        log_edges = np.log2(frequency_edges(freqs))
+        octaves = np.where(responsive, log_edges[right] - log_edges[left + 1], 0.0)
+    return Bandwidth(count, octaves, peak)
+
+
+def get_bandwidth(max_dict):
+    '''
+    Drop-in for the notebook's get_bandwidth: number of frequencies above half max around the peak, per pixel.
+    '''
+    return half_max_bandwidth(max_dict).count.astype(np.float64)
@@ -0,0 +1,211 @@
+'''
+Batch processing of many sessions across a process pool.
+
+compile_zscore_dicts listed every session by hand, and each one was processed by editing config_widefield.json and
+re-running the notebook.  Here a manifest lists the sessions once:
+
+    {
+        "defaults": {"ResponseStart": 6, "ResponseStop": 12},
+        "sessions": [
+            {"animal": "ID468", "group": "saline", "day": 1,
+             "recording": "L:/widefield/ID468_saline/day_1/ID468_08032024_GCaMP6s_1/"},
+            {"animal": "ID325", "group": "psilocybin", "day": 1,
+             "recording": "L:/widefield/ID325_psilo/Day 1/ID325_27062023_GCaMP6s_1/", "overrides": {"TriggerDelay": 20}},
+            ...
+        ]
+    }
+
+Each session's config is config_widefield.json, then the manifest defaults, then RecordingFolder = recording, then the
+session's overrides.  Sessions run the pipeline (functional_analysis/pipeline.py) up to a target stage, one session per
+worker process:
+    - every session gets a fresh process (max_tasks_per_child=1), so memory from one session never piles up in the next
+    - memory_limit caps each worker's address space (Unix only), so a runaway session fails with a MemoryError instead of
+      pushing the node into swap
+    - failed sessions are put back at the end of the queue until they have used up their retries; if a worker dies outright
+      the pool is rebuilt and every session that was running on it counts the attempt
+    - every attempt is appended to a status log (JSON lines) as it finishes, with its status, timings and error, so an
+      overnight run can be followed with tail -f and the end state read back with read_status
+Because the pipeline caches every stage, re-running a batch only recomputes the sessions (and stages) that didn't finish.
+'''
+
+import argparse
+import json
+import os
+import time
+import traceback
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from preprocessing.config import load_config
+
+DEFAULT_TARGET = 'median'
+DEFAULT_RETRIES = 2
+STATUS_NAME = 'batch_status.jsonl'
+
+Session = namedtuple('Session', ['name', 'group', 'day', 'animal', 'config'])
+SessionStatus = namedtuple('SessionStatus', ['name', 'group', 'day', 'animal', 'status', 'attempts', 'seconds', 'stages',
+                                             'output', 'error'])
+
+
+def load_manifest(path, base_config=None):
+    '''
+    Read a batch manifest (see the module docstring).
+    @Param base_config: config the sessions start from, defaults to load_config().
+    @Return: list of Sessions, each with its complete config.
+    '''
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    base_config = load_config() if base_config is None else base_config
+    defaults = manifest.get('defaults', {})
+
+    sessions = []
+    for entry in manifest['sessions']:
+        recording = os.path.join(entry['recording'], '') # the scripts join paths as RecordingFolder + name
+        config = {**base_config, **defaults, 'RecordingFolder': recording, **entry.get('overrides', {})}
+        name = entry.get('name') or '%s_day%s_%s' % (entry.get('group'), entry.get('day'), entry.get('animal'))
+        sessions.append(Session(name, entry.get('group'), entry.get('day'), entry.get('animal'), config))
+
+    names = [session.name for session in sessions]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError('session names must be unique, repeated: ' + ', '.join(duplicates))
+    return sessions
+
+
+def _limit_memory(memory_limit):
+    if memory_limit is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        print('memory_limit is not supported on this platform, workers run without one')
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (int(memory_limit), int(memory_limit)))
+
+
+def run_session(config, target=DEFAULT_TARGET):
+    '''
+    Run one session's pipeline up to target (in a worker process).
+    @Return: (stage runs as (name, status, seconds) tuples, path of the target's cached output or None).
+    '''
+    from functional_analysis.pipeline import Pipeline
+
+    pipeline = Pipeline(config)
+    pipeline.run(target)
+    output = pipeline.cache_path(target) if pipeline.stages[target].cache else None
+    return [tuple(run) for run in pipeline.runs], output
+
+
+def _append_status(status_path, status):
+    with open(status_path, 'a') as f:
+        f.write(json.dumps({**status._asdict(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}, default=str) + '\n')
+
+
+def run_batch(sessions, target=DEFAULT_TARGET, workers=None, memory_limit=None, retries=DEFAULT_RETRIES,
+              status_path=STATUS_NAME):
+    '''
+    Run every session up to target on a process pool.
+    @Param sessions: list of Sessions (load_manifest).
+    @Param workers: number of sessions run at once, defaults to the number of cores.
+    @Param memory_limit: per-worker address-space limit in bytes (None for no limit).
+    @Param retries: how many times a failed session is tried again.
+    @Param status_path: JSON-lines file every attempt is appended to.
+    @Return: list of the final SessionStatus of every session, in manifest order.
+    '''
+    workers = workers or os.cpu_count() or 1
+
+    def make_pool():
+        return ProcessPoolExecutor(max_workers=workers, initializer=_limit_memory, initargs=(memory_limit,),
+                                   max_tasks_per_child=1)
+
+    queue = deque(sessions)
+    attempts = {session.name: 0 for session in sessions}
+    final = {}
+    running = {}
+    pool = make_pool()
+    try:
+        while queue or running:
+            while queue and len(running) < workers:
+                session = queue.popleft()
+                attempts[session.name] += 1
+                running[pool.submit(run_session, session.config, target)] = (session, time.monotonic())
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = any(isinstance(future.exception(), BrokenProcessPool) for future in done)
+            if broken:
+                # every session still running on a broken pool fails with it
+                wait(running)
+                done = set(running)
+
+            for future in done:
+                session, start = running.pop(future)
+                seconds = time.monotonic() - start
+                try:
+                    stages, output = future.result()
+                    status, error = 'done', None
+                except BrokenProcessPool:
+                    stages, output = [], None
+                    status, error = 'failed', 'worker process died (out of memory or killed)'
+                except Exception as e:
+                    stages, output = [], None
+                    status, error = 'failed', ''.join(traceback.format_exception_only(type(e), e)).strip()
+
+                if status == 'failed' and attempts[session.name] <= retries:
+                    status = 'retrying'
+                    queue.append(session)
+                record = SessionStatus(session.name, session.group, session.day, session.animal, status,
+                                       attempts[session.name], round(seconds, 3), stages, output, error)
+                _append_status(status_path, record)
+                print('%-30s %-8s attempt %d  %8.1f s%s' % (session.name, status, attempts[session.name], seconds,
+                                                             '  ' + error if error else ''))
+                if status != 'retrying':
+                    final[session.name] = record
+
+            if broken:
+                pool.shutdown(wait=False)
+                pool = make_pool()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return [final[session.name] for session in sessions]
+
+
+def read_status(status_path=STATUS_NAME):
+    '''
+    Latest status of every session in a status log.
+    @Return: {session name: dict of the last attempt's record}.
+    '''
+    latest = {}
+    with open(status_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                latest[record['name']] = record
+    return latest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the pipeline over every session in a manifest on a process pool')
+    parser.add_argument('manifest', help='JSON manifest of sessions')
+    parser.add_argument('--config', default=None, help='config_widefield.json the sessions start from')
+    parser.add_argument('--target', default=DEFAULT_TARGET, help='pipeline stage to run every session up to')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--memory-limit', type=float, default=None, help='per-worker memory limit in GB')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES)
+    parser.add_argument('--status', default=STATUS_NAME, help='status log (JSON lines)')
+    args = parser.parse_args()
+
+    sessions = load_manifest(args.manifest, load_config(args.config))
+    memory_limit = None if args.memory_limit is None else args.memory_limit * 2 ** 30
+
+    start_time = time.monotonic()
+    results = run_batch(sessions, args.target, args.workers, memory_limit, args.retries, args.status)
+    n_done = sum(result.status == 'done' for result in results)
+    print('%d of %d sessions done in %.1f s' % (n_done, len(results), time.monotonic() - start_time))
+    for result in results:
+        if result.status != 'done':
+            print('FAILED ' + result.name + ': ' + result.error)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''
+Vectorized best-frequency maps.
+
+get_best_frequency rebuilt its input through list(thresholded_dict[freq]) and then called
+np.where(max_array[:,i,j] == max_array[:,i,j].max()) once per pixel in a Python double loop.  Here the per-frequency maps
+are stacked once into a N_freqs x N_pixels x N_pixels array, and a partial sort along the frequency axis gives the largest
+and second largest response of every pixel in one call.  That is enough for:
+    - index:  position of the winning frequency (NaN where two or more frequencies tie for the maximum, as before)
+    - value:  the winning response
+    - margin: how far the winner is ahead of the runner-up (0 for ties), a cheap measure of how well-tuned a pixel is
+Pixels with a NaN in any frequency map come out as NaN in all three, which is also what the per-pixel version gave.
+'''
+
+from collections import namedtuple
+
+import numpy as np
+
+BestFrequency = namedtuple('BestFrequency', ['index', 'value', 'margin'])
+
+
+def stack_maps(map_dict):
+    '''
+    Stack a dict of per-frequency maps into one array.
+    @Param map_dict: keys are frequencies, values are N_pixels x N_pixels maps (a leading 1 x axis, as zscore_and_median
+    returns, is dropped).
+    @Return: (freqs, maps) - the keys in dict order and a N_freqs x N_pixels x N_pixels float64 array.
+    '''
+    freqs = list(map_dict)
+    maps = np.empty((len(freqs),) + np.shape(map_dict[freqs[0]])[-2:], dtype=np.float64)
+    for k, freq in enumerate(freqs):
+        maps[k] = np.reshape(map_dict[freq], maps.shape[1:])
+    return np.array(freqs), maps
+
+
+def threshold_maps(map_dict, threshold):
+    '''
+    Raise every value below threshold up to threshold (so sub-threshold pixels tie and drop out of the best-frequency map).
+    '''
+    return {key: np.clip(value, a_min=threshold, a_max=None) for key, value in map_dict.items()}
+
+
+def best_frequency(maps):
+    '''
+    Best frequency of every pixel.
+    @Param maps: dict of per-frequency maps or a N_freqs x N_pixels x N_pixels array.
+    @Return: BestFrequency(index, value, margin), each N_pixels x N_pixels.  index is the position of the winning frequency
+    in the dict (0 - N_freqs-1) as a float, NaN where the maximum is tied; margin is NaN when there is only one frequency.
+    '''
+    if isinstance(maps, dict):
+        maps = stack_maps(maps)[1]
+    maps = np.asarray(maps, dtype=np.float64)
+    n_freqs = len(maps)
+
+    index = np.argmax(maps, axis=0).astype(np.float64)
+    value = np.max(maps, axis=0)
+    if n_freqs > 1:
+        runner_up = np.partition(maps, n_freqs - 2, axis=0)[n_freqs - 2]
+        margin = value - runner_up
+        index[margin == 0] = np.nan
+    else:
+        margin = np.full(value.shape, np.nan)
+
+    missing = np.isnan(maps).any(axis=0)
+    index[missing] = np.nan
+    value[missing] = np.nan
+    margin[missing] = np.nan
+    return BestFrequency(index, value, margin)
@@ -0,0 +1,159 @@
+'''
+Cohort-level bandwidth histograms.
+
+get_bandwidth_percentages (widefield_bandwidth notebook) looped over the animals of one group / day, recomputed
+get_max_dict and get_bandwidth for each, built the histograms with Counter over flattened Python lists (setdefault-ing
+the missing bandwidths) and saved two hand-named CSVs per group and day (saline_day1_active.csv, ...), which
+plot_normalized_bandwidth then loaded one by one.  Here every animal of every group / day is one task on a process pool:
+the trial-averaged max map of each frequency is computed from the reps' response frames only, the bandwidth comes from
+the vectorized half_max_bandwidth, and the histogram is one integer bincount.  All animals end up in a single tidy table,
+one row per (group, day, animal, bandwidth), so one CSV holds the whole cohort and cohort_percentages gives back the old
+animals x bandwidths arrays.
+
+get_max_dict copied reps 1..n-1 of the {rep: trial} dict (reps keyed 1..n) into an np.empty array of n slots, so the last
+rep was dropped and the last slot, uninitialised memory, was averaged in; trial_max_maps averages all n reps.
+'''
+
+import argparse
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from functional_analysis.bandwidth import half_max_bandwidth
+from preprocessing.config import load_config
+
+COLUMNS = ['group', 'day', 'animal', 'bandwidth', 'n_pixels', 'percent_all', 'percent_active']
+
+
+def trial_max_maps(freq_dict, start, stop):
+    '''
+    Peak of the trial-averaged z-scored response of every pixel, per frequency (the notebook's get_max_dict).
+    @Param freq_dict: {frequency: reps}, reps being N_frames x N_pixels x N_pixels z-scored trials as a {rep: trial} dict
+    (the legacy zscore_dict.pkl, reps keyed 1..n), a list / array, or a TrialTensor.
+    @Param start, stop: response window in frames (ResponseStart / ResponseStop).
+    @Return: {frequency: N_pixels x N_pixels max map}, frequencies in ascending order.
+    '''
+    max_dict = {}
+    for freq in sorted(freq_dict):
+        reps = freq_dict[freq]
+        if isinstance(reps, dict):
+            reps = list(reps.values())
+        total = None
+        for rep in reps:
+            window = np.asarray(rep[start:stop], dtype=np.float64)
+            total = window.copy() if total is None else total + window
+        max_dict[freq] = (total / len(reps)).max(axis=0)
+    return max_dict
+
+
+def bandwidth_histogram(counts, n_freqs):
+    '''
+    Histogram of per-pixel bandwidths (numbers of frequencies).
+    @Param counts: integer bandwidth map (half_max_bandwidth(...).count).
+    @Return: n_freqs + 1 array of pixel counts for bandwidths 0 (unresponsive) to n_freqs.
+    '''
+    return np.bincount(np.ravel(counts), minlength=n_freqs + 1)
+
+
+def _load(source):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return pickle.load(f)
+    return source
+
+
+def animal_bandwidth_histogram(zscore_dict, start, stop):
+    '''
+    Bandwidth histogram of one animal.
+    @Param zscore_dict: the animal's {frequency: reps} dict, or the path of its zscore_dict.pkl.
+    @Return: n_freqs + 1 array of pixel counts for bandwidths 0 to n_freqs.
+    '''
+    max_dict = trial_max_maps(_load(zscore_dict), start, stop)
+    return bandwidth_histogram(half_max_bandwidth(max_dict).count, len(max_dict))
+
+
+def iter_animals(cohorts):
+    '''
+    Flatten {(group, day): animals} into (group, day, animal, zscore_dict) tasks.
+    @Param cohorts: animals is either {animal: zscore_dict or path of its zscore_dict.pkl} or the path of a compiled
+    cohort pickle (compile_zscore_dicts' saline_day1.pkl etc., holding {animal: zscore_dict}).
+    '''
+    for (group, day), animals in cohorts.items():
+        for animal, source in _load(animals).items():
+            yield group, day, animal, source
+
+
+def histogram_rows(group, day, animal, histogram):
+    '''
+    Tidy rows of one animal's histogram, with the percentages get_bandwidth_percentages computed: of all pixels, and of
+    the responsive (bandwidth > 0) pixels - NaN for bandwidth 0.
+    '''
+    n_all = histogram.sum()
+    n_active = n_all - histogram[0]
+    percent_all = histogram / n_all * 100
+    percent_active = histogram / n_active * 100 if n_active else np.zeros(len(histogram))
+    percent_active = np.where(np.arange(len(histogram)) > 0, percent_active, np.nan)
+    return [(group, day, animal, b, int(histogram[b]), percent_all[b], percent_active[b]) for b in range(len(histogram))]
+
+
+def cohort_bandwidth_table(cohorts, start, stop, workers=None, use_processes=True):
+    '''
+    Bandwidth histograms of every animal of every group / day, computed in parallel, as one tidy table.
+    @Param cohorts: {(group, day): animals}, see iter_animals.
+    @Param start, stop: response window in frames (ResponseStart / ResponseStop).
+    @Param workers: pool size, defaults to the number of cores.
+    @Param use_processes: process pool (default) or threads.  Paths are cheaper to hand to processes than loaded dicts.
+    @Return: DataFrame with COLUMNS, one row per group, day, animal and bandwidth (0 to N_freqs), in input order.
+    '''
+    import pandas as pd
+
+    tasks = list(iter_animals(cohorts))
+    pool_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_type(max_workers=workers or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(animal_bandwidth_histogram, source, start, stop) for _, _, _, source in tasks]
+        rows = []
+        for (group, day, animal, _), future in zip(tasks, futures):
+            rows += histogram_rows(group, day, animal, future.result())
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def cohort_percentages(table, group, day, active=True):
+    '''
+    One group / day as the animals x bandwidths array get_bandwidth_percentages returned (and the per-cohort CSVs held).
+    @Param table: cohort_bandwidth_table's DataFrame, or the CSV it was saved to.
+    @Param active: percentages of responsive pixels over bandwidths 1.. (the *_active.csv files), or of all pixels over
+    bandwidths 0.. (the *_all.csv files).
+    @Return: (animals, N_animals x N_bandwidths array).
+    '''
+    import pandas as pd
+
+    if not isinstance(table, pd.DataFrame):
+        table = pd.read_csv(table)
+    rows = table[(table['group'] == group) & (table['day'] == day)]
+    if active:
+        rows = rows[rows['bandwidth'] > 0]
+    wide = rows.pivot(index='animal', columns='bandwidth', values='percent_active' if active else 'percent_all')
+    animals = list(pd.unique(rows['animal']))
+    return animals, wide.loc[animals].to_numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bandwidth histograms of whole cohorts, saved as one tidy CSV')
+    parser.add_argument('output', help='.csv file to write')
+    parser.add_argument('--cohort', nargs=3, action='append', required=True, metavar=('GROUP', 'DAY', 'PICKLE'),
+                        help='a compiled cohort pickle ({animal: zscore_dict}); repeat for every group / day')
+    parser.add_argument('--config', default=None, help='config_widefield.json to take ResponseStart/ResponseStop from')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    cohorts = {(group, day): path for group, day, path in args.cohort}
+    table = cohort_bandwidth_table(cohorts, config['ResponseStart'], config['ResponseStop'], workers=args.workers)
+    table.to_csv(args.output, index=False)
+    print('Wrote %d animals to %s' % (len(table[['group', 'day', 'animal']].drop_duplicates()), args.output))
+
+
+if __name__ == '__main__':
+    main()
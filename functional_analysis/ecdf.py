@@ -0,0 +1,101 @@
+'''
+Empirical CDFs and two-sample Kolmogorov-Smirnov tests with NumPy.
+
+calculate_cdf (widefield_bandwidth notebook) built a pandas Series and DataFrame, grouped by value, counted and cumsum-ed
+just to get an ECDF, once per group and day inside plot_cdf / plot_cdf_all_days.  Here the ECDF of a sample is np.unique
+with counts and a cumsum, and many samples are done in one call: they are concatenated, mapped onto their common support
+with a single np.unique, and counted with one bincount over (sample, value) pairs, giving every sample's CDF on the same
+support as a N_samples x N_values array.
+
+Because every ECDF is a step function that only changes at data values, the two-sample KS statistic is exactly the largest
+difference between two rows of that array, so the group comparisons come almost for free once the CDFs are there.  P-values
+are scipy's ks_2samp method='asymp' ones, which is what applies at pixel-count sample sizes.  NaNs (e.g. bandwidth maps
+with the unresponsive pixels set to NaN) are dropped.
+'''
+
+from collections import namedtuple
+from itertools import combinations
+
+import numpy as np
+
+ECDF = namedtuple('ECDF', ['value', 'frequency', 'pdf', 'cdf'])
+BatchECDF = namedtuple('BatchECDF', ['labels', 'support', 'counts', 'cdf', 'n'])
+KSResult = namedtuple('KSResult', ['a', 'b', 'statistic', 'pvalue'])
+
+
+def _finite(data):
+    data = np.ravel(np.asarray(data, dtype=np.float64))
+    return data[~np.isnan(data)]
+
+
+def ecdf(data):
+    '''
+    Empirical CDF of one sample.
+    @Param data: array of any shape (flattened, NaNs dropped).
+    @Return: ECDF(value, frequency, pdf, cdf) - the distinct values in ascending order, how often each occurs, and the
+    probability / cumulative probability of each (calculate_cdf's columns).
+    '''
+    value, frequency = np.unique(_finite(data), return_counts=True)
+    pdf = frequency / frequency.sum()
+    return ECDF(value, frequency, pdf, np.cumsum(pdf))
+
+
+def batch_ecdf(samples):
+    '''
+    Empirical CDFs of many samples on their common support, in one pass.
+    @Param samples: {label: data} dict, or a list of arrays (labelled 0, 1, ...).
+    @Return: BatchECDF(labels, support, counts, cdf, n) - support is the sorted distinct values of all samples, counts and
+    cdf are N_samples x len(support) arrays (cdf[i, k] = fraction of sample i <= support[k]) and n the sample sizes.
+    '''
+    if not isinstance(samples, dict):
+        samples = dict(enumerate(samples))
+    labels = list(samples)
+    data = [_finite(samples[label]) for label in labels]
+    n = np.array([len(d) for d in data])
+
+    support, inverse = np.unique(np.concatenate(data), return_inverse=True)
+    sample_index = np.repeat(np.arange(len(data)), n)
+    counts = np.bincount(sample_index * len(support) + inverse, minlength=len(data) * len(support))
+    counts = counts.reshape(len(data), len(support))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cdf = np.cumsum(counts, axis=1) / n[:, np.newaxis] # an empty sample gives a NaN row
+    return BatchECDF(labels, support, counts, cdf, n)
+
+
+def ks_pvalue(statistic, n_a, n_b):
+    '''
+    Asymptotic two-sided p-value of a two-sample KS statistic (the one-sample KS distribution at the effective sample
+    size n_a * n_b / (n_a + n_b), as scipy's ks_2samp method='asymp').
+    '''
+    from scipy.stats import kstwo
+
+    en = np.round(n_a * n_b / (n_a + n_b))
+    return np.clip(kstwo.sf(statistic, en), 0, 1)
+
+
+def ks_2samp(samples, pairs=None):
+    '''
+    Two-sample KS tests between samples, from their batched ECDFs.
+    @Param samples: {label: data} dict, list of arrays or an existing BatchECDF.
+    @Param pairs: list of (label_a, label_b) to compare, defaults to every pair.
+    @Return: list of KSResult(a, b, statistic, pvalue).
+    '''
+    batch = samples if isinstance(samples, BatchECDF) else batch_ecdf(samples)
+    row = {label: k for k, label in enumerate(batch.labels)}
+    if pairs is None:
+        pairs = list(combinations(batch.labels, 2))
+
+    a = np.array([row[pa] for pa, _ in pairs], dtype=np.intp)
+    b = np.array([row[pb] for _, pb in pairs], dtype=np.intp)
+    statistic = np.abs(batch.cdf[a] - batch.cdf[b]).max(axis=1, initial=0)
+    pvalue = ks_pvalue(statistic, batch.n[a], batch.n[b])
+    return [KSResult(pa, pb, d, p) for (pa, pb), d, p in zip(pairs, statistic, pvalue)]
+
+
+def calculate_cdf(data):
+    '''
+    Drop-in for the notebook's calculate_cdf: DataFrame with value, frequency, pdf and cdf columns.
+    '''
+    import pandas as pd
+
+    return pd.DataFrame(ecdf(data)._asdict())
@@ -0,0 +1,136 @@
+'''
+Epoching without copying the video.
+
+epoch_trials used to allocate an N_trials x N_frames x N_pixels x N_pixels float64 array and copy every epoch into it, so
+the recording was stored twice (more, if epochs overlap), and the loop over range(len(onset_frames)-1) silently left the
+last trial as zeros.  EpochView instead records where each trial starts and hands out frames from the source video on
+demand:
+    - epochs[trial] is a view into the video (no copy) when the video is an in-memory array, or just that trial's frames
+      when the video is a lazy FrameSource
+    - epochs[trials] / epochs[a:b] gather only the requested trials
+    - epochs.iter_chunks(n) walks through the trials a block at a time, for stages that reduce over trials
+It is indexed like the old epoched_pixels array (epochs[i,:,j,k], epochs.shape, len(epochs)), so existing functions accept it
+directly.  Memory scales with the video, not with trials x window.
+'''
+
+import numpy as np
+
+DEFAULT_TRIALS_PER_CHUNK = 16
+
+
+def epoch_window(epoch_start_in_ms, epoch_end_in_ms, recording_framerate):
+    '''
+    Frame offsets of the epoch relative to the (rounded) onset frame, as epoch_trials computed them.
+    @Return: (start_offset, n_frames) - the epoch is frames [onset + start_offset, onset + start_offset + n_frames).
+    '''
+    trial_length_in_sec = (epoch_end_in_ms - epoch_start_in_ms) / 1000
+    n_frames = int(trial_length_in_sec * recording_framerate) # s * f/s = f
+    start_offset = epoch_start_in_ms / 1000 * recording_framerate
+    return start_offset, n_frames
+
+
+def epoch_starts(onset_frames, start_offset):
+    # same rounding as epoch_trials: round the onset, add the offset, then truncate to an int
+    return (np.round(np.asarray(onset_frames, dtype=float)) + start_offset).astype(np.intp)
+
+
+class EpochView:
+    '''
+    Lazy N_trials x N_frames x N_pixels x N_pixels view of the trials in a video.
+    @Param video: N_frames x N_pixels x N_pixels ndarray, np.memmap, FrameSource or HDF5 dataset.
+    @Param starts: first frame of each trial.
+    @Param n_frames: frames per trial.
+    Trials that run off either end of the recording are padded with NaN (see .valid).
+    '''
+
+    def __init__(self, video, starts, n_frames):
+        self.video = video
+        self.starts = np.asarray(starts, dtype=np.intp)
+        self.n_frames = int(n_frames)
+        self.n_video_frames = len(video)
+        self.valid = (self.starts >= 0) & (self.starts + self.n_frames <= self.n_video_frames)
+
+    @property
+    def shape(self):
+        return (len(self.starts), self.n_frames) + tuple(self.video.shape[1:])
+
+    @property
+    def ndim(self):
+        return 4
+
+    @property
+    def dtype(self):
+        dtype = np.dtype(self.video.dtype)
+        if not self.valid.all() and dtype.kind not in 'fc':
+            return np.dtype(np.float64) # needs NaN for the padded frames
+        return dtype
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _trial(self, trial):
+        start = self.starts[trial]
+        if self.valid[trial]:
+            return self.video[start:start + self.n_frames]
+
+        # partially outside the recording - copy what exists and pad the rest with NaN
+        out = np.full((self.n_frames,) + tuple(self.video.shape[1:]), np.nan, dtype=self.dtype)
+        lo, hi = max(start, 0), min(start + self.n_frames, self.n_video_frames)
+        if hi > lo:
+            out[lo - start:hi - start] = self.video[lo:hi]
+        return out
+
+    def gather(self, trials):
+        '''
+        Copy the requested trials into one N_trials x N_frames x N_pixels x N_pixels array.
+        '''
+        trials = np.arange(len(self.starts))[trials]
+        out = np.empty((len(trials),) + self.shape[1:], dtype=self.dtype)
+        for k, trial in enumerate(trials):
+            out[k] = self._trial(trial)
+        return out
+
+    def iter_chunks(self, trials_per_chunk=DEFAULT_TRIALS_PER_CHUNK, trials=None):
+        '''
+        Iterate over blocks of trials, so a stage never needs more than trials_per_chunk epochs in memory.
+        @Param trials: optional subset / order of trials to visit (e.g. all reps of one frequency).
+        @Return: generator of (trial_indices, block) with block = len(trial_indices) x N_frames x N_pixels x N_pixels.
+        '''
+        trials = np.arange(len(self.starts)) if trials is None else np.asarray(trials)
+        for k in range(0, len(trials), trials_per_chunk):
+            chunk = trials[k:k + trials_per_chunk]
+            yield chunk, self.gather(chunk)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        trial_key, rest = key[0], key[1:]
+
+        if isinstance(trial_key, slice) or np.ndim(trial_key) > 0:
+            epochs = self.gather(trial_key)
+            return epochs[(slice(None),) + rest] if rest else epochs
+
+        trial = int(trial_key)
+        if trial < 0:
+            trial += len(self.starts)
+        if not 0 <= trial < len(self.starts):
+            raise IndexError('trial %d is out of range for %d trials' % (trial_key, len(self.starts)))
+        epoch = self._trial(trial)
+        return np.asarray(epoch[rest]) if rest else epoch
+
+    def __array__(self, dtype=None, copy=None):
+        epochs = self.gather(slice(None))
+        return epochs if dtype is None else epochs.astype(dtype, copy=False)
+
+
+def epoch_view(video, onset_frames, epoch_start_in_ms, epoch_end_in_ms, recording_framerate):
+    '''
+    Epoch a recording around every onset, without copying it.
+    @Param video: N_frames x N_pixels x N_pixels recording (array or FrameSource).
+    @Param onset_frames: stimulus onsets in frames at the recording framerate (from get_onset_frames).
+    @Param epoch_start_in_ms, epoch_end_in_ms: epoch window relative to onset (config 'EpochStart' / 'EpochEnd').
+    @Param recording_framerate: config 'RecordingFR'.
+    @Return: EpochView of shape N_trials x N_frames x N_pixels x N_pixels, one trial per onset (including the last one).
+    '''
+    start_offset, n_frames = epoch_window(epoch_start_in_ms, epoch_end_in_ms, recording_framerate)
+    return EpochView(video, epoch_starts(onset_frames, start_offset), n_frames)
@@ -0,0 +1,328 @@
+'''
+Live tonotopic map while the recording is being acquired.
+
+Whether the window is any good used to be known only after the session, once plot_tonotopic_map_2024.py had processed the
+finished recording.  Live mode follows the recording folder while the camera is still writing it:
+    - new frame TIFFs (one file per frame, or multi-page stacks) are picked up in sorted filename order, downsampled and
+      streamed into a StreamingTrialStats (functional_analysis/streaming.py).  The newest file is left alone until the
+      next one appears, since the camera may still be writing it
+    - new rows of the growing trigger CSV are read from where the last poll stopped and triggers are detected on just
+      those rows (rising edges above a fixed threshold, with the same refractory rule as preprocessing/triggers.py)
+    - every trigger (after the start triggers) becomes a trial of the next condition in the stim_data .mat, and each
+      trial is folded into the per-condition statistics as soon as its last frame has arrived
+    - every N completed trials the median maps go through the pipeline's normalize / threshold / best_frequency stages
+      and the map is redrawn (or saved)
+Frames are only streamed in while the triggers seen so far guarantee that no trial still to be detected starts before
+the oldest frame in the ring buffer; frames that arrive ahead of the trigger CSV wait in memory until it catches up.
+An update costs one poll (a few new frames and CSV rows), one trial reduction and a median over the reps so far - tens of
+ms for 256x256 maps - so it keeps up easily with a 5 s inter-trial interval.  When the acquisition stops (no new data
+for --idle-timeout seconds, or Ctrl-C) the remaining trials are flushed and the final map is the one the pipeline gives
+for the finished recording.
+
+    python -m functional_analysis.live --every 4
+    python -m preprocessing.simulate_acquisition <recording> <trigger csv> <conditions .mat> <folder>   (test drive)
+'''
+
+import argparse
+import os
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from functional_analysis.pipeline import (best, conditions_path, load_conditions, normalize, parse_overrides,
+                                          plot_best_frequency, recording_path, threshold, triggers_path)
+from functional_analysis.streaming import StreamingTrialStats
+from preprocessing import triggers
+from preprocessing.config import load_config
+from preprocessing.frame_source import list_tiffs, open_recording
+
+TRIGGER_THRESHOLD = 2.5 # volts; the triggers are 5 V TTL pulses, and the live trace has no final maximum to round to
+DEFAULT_EVERY = 4 # trials between map updates
+DEFAULT_POLL_S = 0.2 # seconds between polls of the folder
+DEFAULT_IDLE_TIMEOUT_S = 30 # acquisition is over after this long without new frames or trigger rows
+
+LiveUpdate = namedtuple('LiveUpdate', ['n_trials', 'n_frames', 'median_maps', 'thresholded', 'best', 'seconds'])
+
+
+class CsvTail:
+    '''
+    Reads the rows appended to a CSV since the last read.  Only complete lines are parsed; the header line is skipped.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.header_read = False
+
+    def read(self):
+        '''
+        @Return: N_new_rows x N_columns array (empty if nothing new).
+        '''
+        if not os.path.exists(self.path):
+            return np.empty((0, 2))
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1 # a line still being written is left for the next read
+        lines = data[:end].decode().splitlines()
+        self.offset += end
+        if lines and not self.header_read:
+            lines = lines[1:]
+            self.header_read = True
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return np.empty((0, 2))
+        return np.loadtxt(lines, delimiter=',', ndmin=2)
+
+
+class TriggerTracker:
+    '''
+    Incremental trigger detection: the same rising-edge and refractory rule as triggers.detect_trigger_times with a fixed
+    threshold, applied to the trace a block of rows at a time.
+    '''
+
+    def __init__(self, threshold=TRIGGER_THRESHOLD, refractory_in_s=triggers.REFRACTORY_IN_S):
+        self.threshold = threshold
+        self.refractory_in_ms = refractory_in_s * 1000
+        self.covered_ms = -np.inf # time of the last sample read
+        self._high = False
+        self._last = -np.inf
+
+    def update(self, stimulus):
+        '''
+        @Param stimulus: new N_samples x 2 rows of (time in ms, voltage).
+        @Return: times (ms) of the triggers that start in these rows.
+        '''
+        if len(stimulus) == 0:
+            return np.empty(0)
+        times, voltage = stimulus[:, 0], stimulus[:, 1]
+        high = voltage >= self.threshold
+        edges = np.flatnonzero(high & ~np.concatenate(([self._high], high[:-1])))
+        self._high = bool(high[-1])
+        self.covered_ms = times[-1]
+
+        new = []
+        for t in times[edges]:
+            if t - self._last > self.refractory_in_ms:
+                new.append(t)
+                self._last = t
+        return np.array(new)
+
+
+class FolderTail:
+    '''
+    Frames of the TIFFs added to a folder since the last poll, read in sorted filename order.  File names have to sort in
+    acquisition order (zero-padded frame numbers, as the camera writes them).
+    '''
+
+    def __init__(self, folder, downsample=1, dtype=None):
+        self.folder = folder
+        self.downsample = downsample
+        self.dtype = dtype
+        self.n_files = 0
+        self.n_frames = 0
+
+    def poll(self, final=False):
+        '''
+        @Param final: also read the newest file (normally left until the next one appears).
+        @Return: list of (first_index, frames) chunks.
+        '''
+        files = list_tiffs(self.folder) if os.path.isdir(self.folder) else []
+        ready = files if final else files[:-1]
+        chunks = []
+        for path in ready[self.n_files:]:
+            source = open_recording(path, downsample=self.downsample, dtype=self.dtype)
+            frames = np.array(source.read(0, len(source))) # a copy, so the file isn't held open by a memmap
+            source.close()
+            chunks.append((self.n_frames, frames))
+            self.n_frames += len(frames)
+        self.n_files = max(self.n_files, len(ready))
+        return chunks
+
+
+class LiveSession:
+    '''
+    Incremental tonotopic map of a recording that is still being written.
+    @Param config: config dict; RecordingFolder + TIFF is the folder the camera writes to, RecordingFolder + Triggers the
+    growing trigger CSV and RecordingFolder + Conditions the stim_data .mat.
+    @Param every: completed trials between map updates.
+    @Param threshold: trigger voltage threshold.
+    '''
+
+    def __init__(self, config, every=DEFAULT_EVERY, threshold=TRIGGER_THRESHOLD):
+        self.config = config
+        self.every = every
+        self.stats = StreamingTrialStats.from_config(config)
+        self.frames = FolderTail(recording_path(config), config['DownsampleFactor'], config['DownsampleDtype'])
+        self.csv = CsvTail(triggers_path(config))
+        self.tracker = TriggerTracker(threshold)
+        self.conditions = None
+        self.onset_frames = [] # every stimulus onset so far, in frames
+        self.n_triggers = 0 # including the start triggers
+        self._waiting = deque() # (first_index, frames) read from disk but not streamed in yet
+        self._n_updated = 0
+
+    def _load_conditions(self):
+        if self.conditions is None and os.path.exists(conditions_path(self.config)):
+            self.conditions = load_conditions(self.config)
+
+    def _read_triggers(self):
+        rows = self.csv.read()
+        times = self.tracker.update(rows)
+        n_start = max(0, triggers.N_START_TRIGGERS - self.n_triggers)
+        self.n_triggers += len(times)
+        onsets = triggers.trigger_times_to_frames(times, self.config['TriggerDelay'], self.config['RecordingFR'], n_start)
+        self.onset_frames += list(onsets)
+        return len(rows)
+
+    def _add_trials(self):
+        if self.conditions is None:
+            return
+        stop = min(len(self.onset_frames), len(self.conditions)) # extra onsets are ignored, as in format_trials
+        first = self.stats.n_trials
+        if stop > first:
+            self.stats.add_trials(self.onset_frames[first:stop], self.conditions[first:stop])
+
+    def _frame_bound(self):
+        # frames below this can be streamed in: every trial that can still be added starts no earlier than bound - n_frames
+        stats = self.stats
+        if self.conditions is not None and stats.n_trials == len(self.conditions):
+            return np.inf
+        covered = (self.tracker.covered_ms + self.config['TriggerDelay']) / 1000 * self.config['RecordingFR']
+        earliest = np.floor(covered + stats.start_offset) - 1 # start of a trial whose trigger hasn't been read yet
+        pending = self.onset_frames[stats.n_trials:] # detected, but waiting for its condition
+        if pending:
+            earliest = min(earliest, np.round(pending[0]) + stats.start_offset - 1)
+        return earliest + stats.n_frames
+
+    def _stream_frames(self, bound):
+        while self._waiting:
+            first_index, frames = self._waiting[0]
+            n = int(min(len(frames), max(bound - first_index, 0)))
+            if n == 0:
+                break
+            self.stats.push(first_index, frames[:n])
+            if n == len(frames):
+                self._waiting.popleft()
+            else:
+                self._waiting[0] = (first_index + n, frames[n:])
+
+    def poll(self, final=False):
+        '''
+        Read whatever has been written since the last poll and fold it in.
+        @Return: (LiveUpdate or None if the map wasn't due an update, number of new frames + trigger rows).
+        '''
+        start = time.monotonic()
+        self._load_conditions()
+        n_rows = self._read_triggers()
+        self._add_trials()
+        chunks = self.frames.poll(final)
+        self._waiting.extend(chunks)
+        self._stream_frames(np.inf if final else self._frame_bound())
+
+        n_new = n_rows + sum(len(frames) for _, frames in chunks)
+        if self.stats.n_completed and self.stats.n_completed - self._n_updated >= self.every:
+            return self.update(start), n_new
+        return None, n_new
+
+    def update(self, start=None):
+        '''
+        Map of the trials completed so far, through the pipeline's normalize / threshold / best_frequency stages.
+        '''
+        start = time.monotonic() if start is None else start
+        median_maps = self.stats.median_maps()
+        thresholded = threshold(self.config, normalize(self.config, median_maps))
+        best_freq = best(self.config, thresholded)
+        self._n_updated = self.stats.n_completed
+        return LiveUpdate(self.stats.n_completed, self.stats.ring.n_seen, median_maps, thresholded, best_freq,
+                          time.monotonic() - start)
+
+    def finish(self):
+        '''
+        Acquisition is over: read the last file and CSV rows, flush the trials waiting for frames and make the final map.
+        '''
+        start = time.monotonic()
+        self.poll(final=True)
+        self.stats.finish()
+        return self.update(start) if self.stats.n_completed else None
+
+
+def run_live(config, every=DEFAULT_EVERY, poll_s=DEFAULT_POLL_S, idle_timeout=DEFAULT_IDLE_TIMEOUT_S, on_update=None,
+             threshold=TRIGGER_THRESHOLD):
+    '''
+    Follow a recording until nothing new has arrived for idle_timeout seconds (or Ctrl-C).
+    @Param on_update: called with every LiveUpdate, including the final one.
+    @Return: the final LiveUpdate.
+    '''
+    session = LiveSession(config, every, threshold)
+    last_activity = time.monotonic()
+    try:
+        while time.monotonic() - last_activity < idle_timeout:
+            polled = time.monotonic()
+            update, n_new = session.poll()
+            if n_new:
+                last_activity = polled
+            if update is not None and on_update is not None:
+                on_update(update)
+            time.sleep(max(0, poll_s - (time.monotonic() - polled)))
+    except KeyboardInterrupt:
+        print('Stopped, finishing the map with what has arrived')
+
+    update = session.finish()
+    if update is not None and on_update is not None:
+        on_update(update)
+    return update
+
+
+class MapDisplay:
+    '''
+    on_update callback that redraws one figure in place, or saves it to save_path (written atomically, so an image
+    viewer never sees half a file).
+    '''
+
+    def __init__(self, save_path=None):
+        self.save_path = save_path
+        self.fig = None
+
+    def __call__(self, update):
+        from matplotlib import pyplot as plt
+
+        print('%3d trials  %6d frames  map updated in %5.0f ms' % (update.n_trials, update.n_frames, update.seconds * 1000))
+        self.fig = plot_best_frequency(update.thresholded, update.best, self.fig)
+        self.fig.axes[0].set_title('Live map, %d trials' % update.n_trials)
+        if self.save_path:
+            root, extension = os.path.splitext(self.save_path)
+            self.fig.savefig(root + '.part' + extension)
+            os.replace(root + '.part' + extension, self.save_path)
+        else:
+            plt.pause(0.001)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update the tonotopic map while the recording is being acquired')
+    parser.add_argument('--config', default=None, help='config_widefield.json (default: two folders above this one)')
+    parser.add_argument('--set', nargs='*', default=[], metavar='KEY=VALUE', help='override config values for this run')
+    parser.add_argument('--every', type=int, default=DEFAULT_EVERY, help='trials between map updates')
+    parser.add_argument('--poll', type=float, default=DEFAULT_POLL_S, help='seconds between polls of the folder')
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT_S,
+                        help='stop after this many seconds without new frames or triggers')
+    parser.add_argument('--threshold', type=float, default=TRIGGER_THRESHOLD, help='trigger voltage threshold')
+    parser.add_argument('--save-plot', default=None, help='save the map to this file on every update instead of showing it')
+    args = parser.parse_args()
+
+    config = {**load_config(args.config), **parse_overrides(args.set)}
+    if not args.save_plot:
+        from matplotlib import pyplot as plt
+        plt.ion()
+    update = run_live(config, args.every, args.poll, args.idle_timeout, MapDisplay(args.save_plot), args.threshold)
+    if update is None:
+        print('No complete trials arrived')
+    elif not args.save_plot:
+        from matplotlib import pyplot as plt
+        plt.ioff()
+        plt.show()
+
+
+if __name__ == '__main__':
+    main()
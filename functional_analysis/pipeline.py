@@ -0,0 +1,302 @@
+r'''
+End-to-end tonotopic map pipeline with a content-hash cache.
+
+A run used to mean editing main() in plot_tonotopic_map_2024.py and commenting stages in and out (loading, epoching and
+z-scoring were commented out, and the script read max_dict_test.pkl instead).  Here the stages are declared once as a DAG:
+
+    conditions ------------------------------------.
+    load --------------.                            \
+    onsets ------------ epoch -- zscore ------------ median -- normalize -- threshold -- best_frequency -- plot
+                                                                                 \_________________________/
+
+and the runner works out what has to be computed for a target.  Every stage has a key: a hash of its name, the
+config_widefield.json values it reads, the keys of its inputs and, for stages that read files, a fingerprint of those files.
+A stage's output is cached as <cache_dir>/<stage>-<key>.pkl, so:
+    - a stage whose key is unchanged is loaded from the cache, and nothing upstream of it is touched at all
+    - changing a config value only changes the keys of the stages that read it and of everything downstream; changing
+      ZscoreThreshold re-runs threshold and best_frequency from the cached normalized maps, in milliseconds
+    - replacing a recording, trigger CSV or conditions file changes its fingerprint and so every stage that depends on it
+    - --force recomputes the named stages and everything downstream of them, whatever is cached
+load and epoch are lazy views of the recording (FrameSource / EpochView), so they are never cached - only their keys are.
+zscore is the fused baseline / z-score / response-mean kernel (baseline adjustment doesn't change a z-score, so it has no
+stage of its own); its per-trial responses are the expensive part and the only large cache file.
+
+    python -m functional_analysis.pipeline --set ZscoreThreshold=2.5
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from functional_analysis.best_frequency import best_frequency, threshold_maps
+from functional_analysis.epochs import epoch_view
+from functional_analysis.zscore import median_by_condition, trial_zscore_responses
+from preprocessing import triggers
+from preprocessing.config import load_config
+from preprocessing.frame_source import list_tiffs, open_recording
+
+CACHE_DIR_NAME = 'pipeline_cache' # inside RecordingFolder unless --cache-dir is given
+HASH_CONTENT_BYTES = 1 << 26 # single files up to ~64 MB are fingerprinted by content, larger ones by size and mtime
+N_SILENT_STIMS = 3 # leading rows of stim_data that correspond to frame 0, not a trial
+
+Stage = namedtuple('Stage', ['name', 'inputs', 'config_keys', 'func', 'files', 'cache'])
+Stage.__new__.__defaults__ = (None, True)
+
+StageRun = namedtuple('StageRun', ['name', 'status', 'seconds'])
+
+
+def _stat_fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def path_fingerprint(path):
+    '''
+    Cheap identity of a file or recording folder for the cache keys.  Single files (trigger CSV, conditions .mat) are
+    content hashed if they are small, larger ones (multi-page recordings) go by size and modification time.  A recording
+    folder is its TIFFs (list_tiffs) by name, size and modification time: hashing every per-frame file would re-read the
+    whole recording on every run, and sidecars written next to it (.npz, widefield.h5, pipeline_cache) must not change
+    the key.
+    '''
+    if os.path.isdir(path):
+        return [[os.path.basename(name), _stat_fingerprint(name)] for name in list_tiffs(path)]
+    if os.path.getsize(path) <= HASH_CONTENT_BYTES:
+        return triggers.file_hash(path)
+    return _stat_fingerprint(path)
+
+
+def recording_path(config):
+    return config['RecordingFolder'] + config['TIFF']
+
+
+def triggers_path(config):
+    return config['RecordingFolder'] + config['Triggers']
+
+
+def conditions_path(config):
+    return config['RecordingFolder'] + config['Conditions']
+
+
+def load_conditions(config):
+    import scipy.io as scio
+
+    conditions = scio.loadmat(conditions_path(config))['stim_data']
+    return conditions[N_SILENT_STIMS:]
+
+
+def load_video(config):
+    return open_recording(recording_path(config), downsample=config['DownsampleFactor'], dtype=config['DownsampleDtype'])
+
+
+def load_onsets(config):
+    return triggers.load_onset_frames(triggers_path(config), config)
+
+
+def epoch(config, video, onset_frames):
+    return epoch_view(video, onset_frames, config['EpochStart'], config['EpochEnd'], config['RecordingFR'])
+
+
+def zscore(config, epochs):
+    return trial_zscore_responses(epochs, config['BaselineFrames'], config['ResponseStart'], config['ResponseStop'])
+
+
+def median(config, responses, conditions):
+    return median_by_condition(responses, conditions)
+
+
+def normalize(config, median_zscore_dict):
+    # z-score each frequency's map across all its pixels, as main() did with scipy.stats.zscore(axis=None), to even out
+    # how responsive the whole cortex is to each frequency
+    normalized = {}
+    for key, value in median_zscore_dict.items():
+        value = np.squeeze(value)
+        normalized[key] = (value - value.mean()) / value.std()
+    return normalized
+
+
+def threshold(config, normalized):
+    return threshold_maps(normalized, config['ZscoreThreshold'])
+
+
+def best(config, thresholded):
+    return best_frequency(thresholded)
+
+
+def plot_best_frequency(thresholded, best_freq, fig=None):
+    '''
+    Tonotopic map figure, with the colorbar labelled by the actual frequencies.
+    @Param fig: figure to redraw (e.g. a live map), a new one by default.
+    '''
+    from matplotlib import cm
+    from matplotlib import pyplot as plt
+
+    freqs = list(thresholded)
+    ticks = sorted(set(np.linspace(0, len(freqs) - 1, min(len(freqs), 6)).round().astype(int)))
+    if fig is None:
+        fig, ax = plt.subplots()
+    else:
+        fig.clf()
+        ax = fig.add_subplot()
+    cax = ax.imshow(best_freq.index, cmap=cm.jet, vmin=0, vmax=len(freqs) - 1)
+    cbar = fig.colorbar(cax, ticks=ticks)
+    cbar.ax.set_yticklabels([str(freqs[t]) for t in ticks])
+    cbar.ax.set_ylabel('Frequency (Hz)', labelpad=10)
+    return fig
+
+
+def plot(config, thresholded, best_freq):
+    return plot_best_frequency(thresholded, best_freq)
+
+
+STAGES = [
+    Stage('conditions', (), ('Conditions',), load_conditions, files=conditions_path),
+    Stage('load', (), ('TIFF', 'DownsampleFactor', 'DownsampleDtype'), load_video, files=recording_path, cache=False),
+    Stage('onsets', (), ('Triggers', 'TriggerDelay', 'RecordingFR'), load_onsets, files=triggers_path),
+    Stage('epoch', ('load', 'onsets'), ('EpochStart', 'EpochEnd', 'RecordingFR'), epoch, cache=False),
+    Stage('zscore', ('epoch',), ('BaselineFrames', 'ResponseStart', 'ResponseStop'), zscore),
+    Stage('median', ('zscore', 'conditions'), (), median),
+    Stage('normalize', ('median',), (), normalize),
+    Stage('threshold', ('normalize',), ('ZscoreThreshold',), threshold),
+    Stage('best_frequency', ('threshold',), (), best),
+    Stage('plot', ('threshold', 'best_frequency'), (), plot, cache=False),
+]
+
+
+class Pipeline:
+    '''
+    Runs a DAG of Stages with a content-hash cache.
+    @Param config: config dict (load_config()).
+    @Param stages: list of Stage(name, inputs, config_keys, func, files, cache), inputs listed before the stages using them.
+    func is called as func(config, *input_outputs); files, if given, maps the config to the path(s) the stage reads.
+    @Param cache_dir: where cached outputs go, defaults to RecordingFolder/pipeline_cache.
+    '''
+
+    def __init__(self, config, stages=STAGES, cache_dir=None):
+        self.config = config
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir or os.path.join(config['RecordingFolder'], CACHE_DIR_NAME)
+        self.runs = []
+        self._keys = {}
+        self._outputs = {}
+
+    def key(self, name):
+        '''
+        Cache key of a stage: hash of its name, config values, input keys and file fingerprints.
+        '''
+        if name not in self._keys:
+            stage = self.stages[name]
+            parts = {
+                'stage': name,
+                'config': {k: self.config.get(k) for k in stage.config_keys},
+                'inputs': [self.key(dep) for dep in stage.inputs],
+            }
+            if stage.files is not None:
+                parts['files'] = path_fingerprint(stage.files(self.config))
+            digest = hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode(), digest_size=16)
+            self._keys[name] = digest.hexdigest()
+        return self._keys[name]
+
+    def cache_path(self, name):
+        return os.path.join(self.cache_dir, '%s-%s.pkl' % (name, self.key(name)))
+
+    def _load_cached(self, name):
+        path = self.cache_path(name)
+        if not self.stages[name].cache or not os.path.exists(path):
+            return False, None
+        with open(path, 'rb') as f:
+            return True, pickle.load(f)
+
+    def _save(self, name, output):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(name)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path) # a crash mid-write never leaves a truncated cache entry
+
+    def forced_stages(self, force):
+        '''
+        The stages in force and every stage downstream of one: a recomputed stage invalidates everything that reads it,
+        even where a cache entry under the same key exists.
+        '''
+        forced = set(force)
+        for stage in self.stages.values(): # inputs are listed before the stages using them
+            if any(dep in forced for dep in stage.inputs):
+                forced.add(stage.name)
+        return forced
+
+    def run(self, target, force=()):
+        '''
+        Compute (or load) a stage's output, running only the stages whose cache entries are missing.
+        @Param force: names of stages to recompute even if cached, along with everything downstream of them.
+        @Return: the target's output.
+        '''
+        return self._run(target, self.forced_stages(force))
+
+    def _run(self, target, force):
+        if target in self._outputs:
+            return self._outputs[target]
+        stage = self.stages[target]
+
+        start = time.monotonic()
+        found, output = (False, None) if target in force else self._load_cached(target)
+        if found:
+            self.runs.append(StageRun(target, 'cached', time.monotonic() - start))
+        else:
+            inputs = [self._run(dep, force) for dep in stage.inputs]
+            start = time.monotonic()
+            output = stage.func(self.config, *inputs)
+            if stage.cache:
+                self._save(target, output)
+            self.runs.append(StageRun(target, 'ran', time.monotonic() - start))
+        self._outputs[target] = output
+        return output
+
+    def report(self):
+        return '\n'.join('%-15s %-7s %8.3f s' % run for run in self.runs)
+
+
+def parse_overrides(pairs):
+    '''
+    KEY=VALUE strings to a dict, VALUE parsed as JSON if it can be (numbers, lists) and kept as a string otherwise.
+    '''
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the tonotopic map pipeline, re-computing only what changed')
+    parser.add_argument('--config', default=None, help='config_widefield.json (default: two folders above this one)')
+    parser.add_argument('--set', nargs='*', default=[], metavar='KEY=VALUE', help='override config values for this run')
+    parser.add_argument('--target', default='plot', choices=[stage.name for stage in STAGES])
+    parser.add_argument('--force', nargs='*', default=[], metavar='STAGE', help='recompute these stages even if cached')
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--save-plot', default=None, help='save the map to this file instead of showing it')
+    args = parser.parse_args()
+
+    config = {**load_config(args.config), **parse_overrides(args.set)}
+    pipeline = Pipeline(config, cache_dir=args.cache_dir)
+    output = pipeline.run(args.target, force=set(args.force))
+    print(pipeline.report())
+
+    if args.target == 'plot':
+        if args.save_plot:
+            output.savefig(args.save_plot)
+        else:
+            from matplotlib import pyplot as plt
+            plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+'''
+Single-pass trial statistics over a stream of frames.
+
+Even with the lazy EpochView, the session is reduced trial by trial from a video that has to be addressable as a whole, and
+the old flow held the full video, an epoched copy, a baseline-adjusted copy and the z-scored arrays of every frequency at
+the same time.  StreamingTrialStats consumes the frames once, in order, as chunks of any size (FrameSource.iter_chunks,
+a camera writing one file per frame, ...):
+    - the last epoch-length frames are kept in a FrameRing, so a trial can be read back as soon as its last frame has
+      arrived, and nothing older than one epoch is ever held
+    - onsets (and their conditions) can be added before or while the frames arrive; each frame is matched to the trials
+      whose window it falls in by splitting the incoming chunks at the trial end frames
+    - a completed trial is reduced straight away by the fused kernel (zscore_response_block: baseline mean / std and the
+      response-window mean of every pixel) and only its N_pixels x N_pixels response is kept, with the other reps of its
+      condition, for the median
+So the memory is one epoch of frames plus one response map per trial, however long the recording.  The median z-score
+maps are the same as zscore_median_maps gives for the whole session (trials running off the end are NaN-padded in the same
+way), and can be read at any point for the trials completed so far.
+'''
+
+import heapq
+
+import numpy as np
+
+from functional_analysis.epochs import epoch_starts, epoch_window
+from functional_analysis.trials import condition_column
+from functional_analysis.zscore import zscore_response_block
+
+DEFAULT_CHUNK_SIZE = 64 # frames read from the recording at a time by stream_median_maps
+
+
+class FrameRing:
+    '''
+    The last `capacity` frames of a stream, in a fixed circular buffer.
+    Frames have to be pushed in order and without gaps; frame i is stored in slot i % capacity.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.frames = None # allocated on the first push, once the frame shape and dtype are known
+        self.index = np.full(self.capacity, -1, dtype=np.intp) # frame number held in each slot
+        self.n_seen = 0
+
+    def push(self, first_index, frames):
+        '''
+        Append frames [first_index, first_index + len(frames)).  Only the last capacity of them are stored.
+        '''
+        if first_index != self.n_seen:
+            raise ValueError('expected frame %d next, got frame %d' % (self.n_seen, first_index))
+        frames = np.asarray(frames)
+        if self.frames is None:
+            dtype = frames.dtype if frames.dtype.kind in 'fc' else np.float64 # needs NaN for missing frames
+            self.frames = np.empty((self.capacity,) + frames.shape[1:], dtype=dtype)
+
+        stop = first_index + len(frames)
+        tail = frames[-self.capacity:]
+        indices = np.arange(stop - len(tail), stop)
+        self.frames[indices % self.capacity] = tail
+        self.index[indices % self.capacity] = indices
+        self.n_seen = stop
+
+    def window(self, start, stop):
+        '''
+        Copy of frames [start, stop), NaN for frames that are not (or not any more) in the buffer.
+        '''
+        indices = np.arange(start, stop)
+        slots = indices % self.capacity
+        out = self.frames[slots]
+        out[self.index[slots] != indices] = np.nan
+        return out
+
+
+class StreamingTrialStats:
+    '''
+    Per-condition median z-score maps, accumulated as frames stream in.
+    @Param n_baseline_frames: config 'BaselineFrames'.
+    @Param start, stop: response window in frames, config 'ResponseStart' / 'ResponseStop'.
+    @Param epoch_start_in_ms, epoch_end_in_ms: epoch window relative to onset (config 'EpochStart' / 'EpochEnd').
+    @Param recording_framerate: config 'RecordingFR'.
+    '''
+
+    def __init__(self, n_baseline_frames, start, stop, epoch_start_in_ms, epoch_end_in_ms, recording_framerate):
+        self.n_baseline_frames = n_baseline_frames
+        self.start = start
+        self.stop = stop
+        self.start_offset, self.n_frames = epoch_window(epoch_start_in_ms, epoch_end_in_ms, recording_framerate)
+        self.ring = FrameRing(self.n_frames)
+        self.trial_starts = []
+        self.trial_conditions = []
+        self.reps = {} # condition -> list of the N_pixels x N_pixels responses of its completed reps
+        self.n_completed = 0
+        self._pending = [] # heap of (end frame, trial)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['BaselineFrames'], config['ResponseStart'], config['ResponseStop'], config['EpochStart'],
+                   config['EpochEnd'], config['RecordingFR'])
+
+    @property
+    def n_trials(self):
+        return len(self.trial_starts)
+
+    @property
+    def n_pending(self):
+        return len(self._pending)
+
+    def add_trials(self, onset_frames, conditions):
+        '''
+        Register more trials, in presentation order.
+        @Param onset_frames: onsets in (fractional) frames at the recording framerate, as from get_onset_frames.
+        @Param conditions: stim_data rows (frequency in column 0) or one value per onset.
+        @Return: trial numbers of the trials completed by this call (their frames had all arrived already).
+        '''
+        values = condition_column(conditions)
+        if len(values) != len(onset_frames):
+            raise ValueError('%d onsets but %d conditions' % (len(onset_frames), len(values)))
+
+        oldest = self.ring.n_seen - self.n_frames # first frame still in the ring
+        for trial_start, value in zip(epoch_starts(onset_frames, self.start_offset), values):
+            if 0 <= trial_start < oldest:
+                raise ValueError('trial starting at frame %d was added after its frames left the buffer (frame %d is '
+                                 'the oldest kept)' % (trial_start, oldest))
+            heapq.heappush(self._pending, (int(trial_start) + self.n_frames, self.n_trials))
+            self.trial_starts.append(int(trial_start))
+            self.trial_conditions.append(value)
+        return self._complete(self.ring.n_seen)
+
+    def _complete(self, n_available):
+        # reduce every pending trial whose last frame is below n_available
+        completed = []
+        while self._pending and self._pending[0][0] <= n_available:
+            _, trial = heapq.heappop(self._pending)
+            self._reduce(trial)
+            completed.append(trial)
+        return completed
+
+    def _reduce(self, trial):
+        trial_start = self.trial_starts[trial]
+        epoch = self.ring.window(trial_start, trial_start + self.n_frames)
+        response = zscore_response_block(epoch[np.newaxis], self.n_baseline_frames, self.start, self.stop)[0]
+        self.reps.setdefault(self.trial_conditions[trial], []).append(response)
+        self.n_completed += 1
+
+    def push(self, first_index, frames):
+        '''
+        Consume the next chunk of frames.
+        @Param first_index: frame number of frames[0]; chunks must follow on from each other.
+        @Param frames: n_frames x N_pixels x N_pixels.
+        @Return: trial numbers of the trials completed by this chunk.
+        '''
+        frames = np.asarray(frames)
+        stop = first_index + len(frames)
+        completed = []
+        position = first_index
+        # split the chunk at every trial end, so each trial is read back while all of its frames are in the ring
+        while self._pending and self._pending[0][0] <= stop:
+            end = self._pending[0][0]
+            self.ring.push(position, frames[position - first_index:end - first_index])
+            position = end
+            completed += self._complete(position)
+        self.ring.push(position, frames[position - first_index:])
+        return completed
+
+    def finish(self):
+        '''
+        End of the recording: reduce the trials still waiting for frames, NaN-padded past the last frame (as EpochView).
+        @Return: trial numbers of the trials completed.
+        '''
+        completed = []
+        while self._pending:
+            _, trial = heapq.heappop(self._pending)
+            self._reduce(trial)
+            completed.append(trial)
+        return completed
+
+    def median_maps(self):
+        '''
+        Median across the completed reps of each condition.
+        @Return: median_zscore_dict - keys are frequencies (sorted), values are 1 x N_pixels x N_pixels arrays.
+        '''
+        return {value: np.median(np.stack(self.reps[value]), axis=0)[np.newaxis] for value in sorted(self.reps)}
+
+
+def iter_frames(video, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    (first_index, chunk) blocks of a FrameSource, array or HDF5 dataset.
+    '''
+    if hasattr(video, 'iter_chunks'):
+        yield from video.iter_chunks(chunk_size)
+        return
+    for first_index in range(0, len(video), chunk_size):
+        yield first_index, np.asarray(video[first_index:first_index + chunk_size])
+
+
+def stream_median_maps(frames, onset_frames, conditions, config, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    A whole session reduced to its median z-score maps in one pass over the frames.
+    @Param frames: recording (FrameSource, array or HDF5 dataset), or any iterable of (first_index, chunk) blocks.
+    @Param onset_frames: onsets from get_onset_frames / load_onset_frames.
+    @Param conditions: stim_data (frequency in column 0) or one value per trial.  Extra onsets beyond the number of
+    conditions are ignored, as in format_trials.
+    @Param config: config dict, for BaselineFrames, ResponseStart, ResponseStop, EpochStart, EpochEnd and RecordingFR.
+    @Return: median_zscore_dict - keys are frequencies, values are 1 x N_pixels x N_pixels arrays.
+    '''
+    values = condition_column(conditions)
+    if len(values) > len(onset_frames):
+        raise ValueError('%d conditions but only %d trials' % (len(values), len(onset_frames)))
+
+    stats = StreamingTrialStats.from_config(config)
+    stats.add_trials(np.asarray(onset_frames)[:len(values)], values)
+    chunks = iter_frames(frames, chunk_size) if hasattr(frames, 'shape') else frames
+    for first_index, chunk in chunks:
+        stats.push(first_index, chunk)
+    stats.finish()
+    return stats.median_maps()
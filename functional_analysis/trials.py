@@ -0,0 +1,121 @@
+'''
+TrialTensor: all trials of a recording in one array, grouped by condition.
+
+format_trials used to build freq_dict[freq][rep] - a dict of dicts, counted with a temp_map list as long as the largest
+frequency value - and every consumer then copied the reps of each frequency back into a freshly allocated
+[n_reps, 25, 256, 256] array (sized for 10 reps, whatever the session actually had).  A TrialTensor holds:
+    - data: one contiguous N_trials x N_frames x N_pixels x N_pixels array, with the trials sorted (stably) by condition
+    - condition_index: for each row of data, the index of its condition in .conditions
+    - offsets: group boundaries, so the reps of conditions[c] are data[offsets[c]:offsets[c+1]]
+    - trial_order: the original (chronological) trial number of each row
+tensor[freq] is therefore a view of all reps of that frequency (N_reps x N_frames x N_pixels x N_pixels), found in O(1),
+and reps are numbered from 0 in presentation order.  It iterates and indexes like the old freq_dict (for freq in tensor,
+tensor.items(), len(tensor[freq])), for any number of reps and conditions.
+'''
+
+import numpy as np
+
+
+def condition_column(conditions):
+    # stim_data has the frequency in column 0 (and intensity etc. after it); a 1D array is already one value per trial
+    conditions = np.asarray(conditions)
+    return conditions[:, 0] if conditions.ndim > 1 else conditions
+
+
+class TrialTensor:
+    '''
+    Trials grouped by condition in one contiguous array.
+    @Param trials: N_trials x ... array, EpochView or HDF5 dataset of trials in presentation order.
+    @Param conditions: stim_data (frequency in column 0) or a 1D array, one entry per trial.  Extra trials beyond the
+    number of conditions are ignored, as format_trials did.
+    @Param dtype: dtype of the stored trials (defaults to the dtype of trials).
+    '''
+
+    def __init__(self, trials, conditions, dtype=None):
+        values = condition_column(conditions)
+        if len(values) > len(trials):
+            raise ValueError('%d conditions but only %d trials' % (len(values), len(trials)))
+
+        self.conditions, condition_index = np.unique(values, return_inverse=True)
+        self.trial_order = np.argsort(condition_index, kind='stable')
+        self.condition_index = condition_index[self.trial_order]
+        counts = np.bincount(condition_index, minlength=len(self.conditions))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self._lookup = {value: c for c, value in enumerate(self.conditions.tolist())}
+        self.data = self._sorted_trials(trials, dtype)
+
+    def _sorted_trials(self, trials, dtype):
+        n_trials = len(self.trial_order)
+        if isinstance(trials, np.ndarray):
+            data = trials[:n_trials] if np.array_equal(self.trial_order, np.arange(n_trials)) else trials[self.trial_order]
+            return np.ascontiguousarray(data, dtype=dtype)
+
+        # lazy sources (EpochView, h5py) - fill the sorted array a block of trials at a time
+        dtype = trials.dtype if dtype is None else dtype
+        data = np.empty((n_trials,) + tuple(trials.shape[1:]), dtype=dtype)
+        block = 16
+        for k in range(0, n_trials, block):
+            rows = self.trial_order[k:k + block]
+            if hasattr(trials, 'gather'):
+                data[k:k + len(rows)] = trials.gather(rows)
+            else:
+                data[k:k + len(rows)] = np.stack([np.asarray(trials[int(row)]) for row in rows])
+        return data
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def index(self, condition):
+        '''
+        Position of a condition value in .conditions.
+        '''
+        try:
+            return self._lookup[condition.item() if isinstance(condition, np.generic) else condition]
+        except KeyError:
+            raise KeyError(condition) from None
+
+    def group(self, c):
+        '''
+        All reps of the c'th condition, as a view of .data.
+        '''
+        return self.data[self.offsets[c]:self.offsets[c + 1]]
+
+    def n_reps(self, condition):
+        c = self.index(condition)
+        return int(self.offsets[c + 1] - self.offsets[c])
+
+    def trials_of(self, condition):
+        '''
+        Chronological trial numbers of the reps of a condition, in the same order as tensor[condition].
+        '''
+        c = self.index(condition)
+        return self.trial_order[self.offsets[c]:self.offsets[c + 1]]
+
+    def __getitem__(self, condition):
+        return self.group(self.index(condition))
+
+    def __contains__(self, condition):
+        return (condition.item() if isinstance(condition, np.generic) else condition) in self._lookup
+
+    def __iter__(self):
+        return iter(self.conditions)
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def keys(self):
+        return self.conditions
+
+    def values(self):
+        return [self.group(c) for c in range(len(self.conditions))]
+
+    def items(self):
+        return zip(self.conditions, self.values())
+
+    def map(self, func):
+        '''
+        Apply func to the reps of every condition.
+        @Return: dict keyed by condition value, as the old per-frequency dicts were.
+        '''
+        return {value: func(group) for value, group in self.items()}
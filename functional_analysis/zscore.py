@@ -0,0 +1,106 @@
+'''
+Fused baseline / z-score / response-window / median kernel.
+
+baseline_adjust_pixels, get_zscored_response and zscore_and_median walked every trial x row x column in Python (applying a
+lambda element by element), which took hours for a single 256x256 session.  The chain they compute is, per trial and pixel:
+
+    baseline  = trial[:BaselineFrames]
+    zscore    = (trial - mean(baseline)) / std(baseline)
+    response  = mean(zscore[ResponseStart:ResponseStop])
+
+followed by the median of response across the reps of each frequency.  Subtracting the baseline mean first (baseline_adjust)
+doesn't change the z-score, and the mean of the z-scored window is just (mean(window) - mean(baseline)) / std(baseline), so
+the kernel only needs three per-pixel reductions over the baseline and response frames.  They are computed for whole blocks
+of trials at once, broadcasting across all pixels, in a single pass over the epoched data.
+'''
+
+import numpy as np
+
+from functional_analysis.trials import TrialTensor
+
+DEFAULT_TRIALS_PER_CHUNK = 16
+
+
+def _iter_trial_blocks(epochs, trials_per_chunk):
+    # EpochViews know how to gather their own trials; plain arrays (and h5py datasets) are sliced
+    if hasattr(epochs, 'iter_chunks'):
+        yield from epochs.iter_chunks(trials_per_chunk)
+        return
+    for start in range(0, len(epochs), trials_per_chunk):
+        block = np.asarray(epochs[start:start + trials_per_chunk])
+        yield np.arange(start, start + len(block)), block
+
+
+def zscore_response_block(block, n_baseline_frames, start, stop):
+    '''
+    Mean z-scored response of every trial / pixel in a block.
+    @Param block: N_trials x N_frames x N_pixels x N_pixels.
+    @Return: N_trials x N_pixels x N_pixels float64 array.
+    '''
+    block = np.asarray(block)
+    baseline = block[:, :n_baseline_frames].astype(np.float64, copy=False)
+    baseline_mean = baseline.mean(axis=1)
+    baseline_std = baseline.std(axis=1)
+    response_mean = block[:, start:stop].mean(axis=1, dtype=np.float64)
+
+    # flat baselines give inf/nan, as the per-pixel version did, just without a warning for every pixel
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (response_mean - baseline_mean) / baseline_std
+
+
+def trial_zscore_responses(epochs, n_baseline_frames, start, stop, trials_per_chunk=DEFAULT_TRIALS_PER_CHUNK):
+    '''
+    Baseline, z-score and response-window mean for every trial and pixel.
+    @Param epochs: N_trials x N_frames x N_pixels x N_pixels EpochView or array (raw or baseline-adjusted trials).
+    @Param n_baseline_frames: config 'BaselineFrames'.
+    @Param start, stop: response window in frames, config 'ResponseStart' / 'ResponseStop'.
+    @Return: N_trials x N_pixels x N_pixels array of mean z-scored responses.
+    '''
+    n_trials = len(epochs)
+    responses = np.empty((n_trials,) + tuple(epochs.shape[2:]), dtype=np.float64)
+    for trials, block in _iter_trial_blocks(epochs, trials_per_chunk):
+        responses[trials] = zscore_response_block(block, n_baseline_frames, start, stop)
+    return responses
+
+
+def zscore_trials(trials, n_baseline_frames):
+    '''
+    Full z-scored traces: every trial and pixel z-scored against its own baseline frames.
+    @Param trials: N_trials x N_frames x N_pixels x N_pixels (e.g. tensor[freq]).
+    @Return: float64 array of the same shape.
+    '''
+    trials = np.asarray(trials, dtype=np.float64)
+    baseline = trials[:, :n_baseline_frames]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (trials - baseline.mean(axis=1, keepdims=True)) / baseline.std(axis=1, keepdims=True)
+
+
+def median_by_condition(responses, conditions):
+    '''
+    Median across the reps of each frequency.
+    @Param responses: N_trials x N_pixels x N_pixels.
+    @Param conditions: stim_data (frequency in column 0) or a 1D array of frequencies, one per trial.
+    @Return: median_zscore_dict - keys are frequencies (sorted), values are 1 x N_pixels x N_pixels arrays.
+    '''
+    return TrialTensor(responses, conditions).map(lambda reps: np.median(reps, axis=0)[np.newaxis])
+
+
+def condition_median_maps(tensor, n_baseline_frames, start, stop, trials_per_chunk=DEFAULT_TRIALS_PER_CHUNK):
+    '''
+    zscore_and_median for trials that are already grouped into a TrialTensor (format_trials output).
+    @Return: median_zscore_dict - keys are frequencies, values are 1 x N_pixels x N_pixels arrays.
+    '''
+    responses = trial_zscore_responses(tensor.data, n_baseline_frames, start, stop, trials_per_chunk)
+    return {value: np.median(responses[tensor.offsets[c]:tensor.offsets[c + 1]], axis=0)[np.newaxis]
+            for c, value in enumerate(tensor.conditions)}
+
+
+def zscore_median_maps(epochs, conditions, n_baseline_frames, start, stop, trials_per_chunk=DEFAULT_TRIALS_PER_CHUNK):
+    '''
+    The whole baseline -> z-score -> response mean -> median chain in one pass.
+    Replaces baseline_adjust_pixels + format_trials + zscore_and_median.  Unlike zscore_and_median, every rep is used (the
+    old loop over range(1, n_reps) skipped the last rep and took the median over an uninitialised row instead).
+    @Return: median_zscore_dict - keys are frequencies, values are 1 x N_pixels x N_pixels arrays.
+    '''
+    responses = trial_zscore_responses(epochs, n_baseline_frames, start, stop, trials_per_chunk)
+    return median_by_condition(responses, conditions)
@@ -3,18 +3,140 @@
 Created on Wed Sep  7 15:58:23 2022
 
 @author: Conor Lane
+
+Streaming .mj2 -> BigTIFF (or widefield.h5) converter.
+
+The .mj2 is decoded in fixed-size blocks of frames, and each block is written straight to the output, so the whole video
+is never held in memory and no temp.tif is needed.  Frames can optionally be downsampled on the way through.  Several
+.mj2 files can be converted in parallel, one per process.
+
+Usage (from the top of the repository):
+    python -m preprocessing.Trenholm_MJ_to_TIFF wdf_000_a11.mj2 [more.mj2 ...] --output-dir converted/ [--downsample 2]
+Outputs ending in .h5 are written into the chunked store (preprocessing/store.py) instead of a BigTIFF.
 """
-import skvideo
-skvideo.setFFmpegPath('C:/FFmpeg/bin')
-import skvideo.io
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
-import tifffile
 
-# Input filepath to .mj2 video
-fn = "C:/Users/Conor/Documents/Imaging_Data/Widefield_Tests/wdf/RT_056/20220525/wdf/wdf_000_a11.mj2"
+from preprocessing.downsample import downsample_frames
+
+FFMPEG_PATH = 'C:/FFmpeg/bin'
+OUTPUT_PARAMETERS = {'-pix_fmt': 'gray16be'} # specify to import as uint16, otherwise it's uint8
+CHUNK_SIZE = 200 # frames decoded and written per block
+
+
+def read_mj2_frames(fn, ffmpeg_path=FFMPEG_PATH):
+    '''
+    Decode an .mj2 one frame at a time (skvideo.io.vreader streams from ffmpeg rather than reading the whole file).
+    @Return: generator of (N_pixels x N_pixels) uint16 frames.
+    '''
+    import skvideo
+    if ffmpeg_path:
+        skvideo.setFFmpegPath(ffmpeg_path)
+    import skvideo.io
+
+    for frame in skvideo.io.vreader(fn, outputdict=OUTPUT_PARAMETERS):
+        yield np.squeeze(frame)
+
+
+def iter_blocks(frames, chunk_size=CHUNK_SIZE):
+    '''
+    Group a stream of frames into (chunk_size x N_pixels x N_pixels) blocks.
+    '''
+    block = []
+    for frame in frames:
+        block.append(frame)
+        if len(block) == chunk_size:
+            yield np.stack(block)
+            block = []
+    if block:
+        yield np.stack(block)
+
+
+def write_frames(frames, output, chunk_size=CHUNK_SIZE, downsample=1, dtype=None):
+    '''
+    Write a stream of frames to a BigTIFF (.tif) or to the video dataset of a store (.h5), one block at a time.
+    @Param dtype: output dtype ('uint16' or 'float32').  Defaults to the input dtype (uint16), or float32 when downsampling.
+    @Return: number of frames written.
+    '''
+    n_frames = 0
+    store = dataset = writer = None
+    try:
+        for block in iter_blocks(frames, chunk_size):
+            if dtype is not None:
+                out_dtype = np.dtype(dtype)
+            else:
+                out_dtype = np.dtype(np.float32 if downsample > 1 else block.dtype)
+            block = downsample_frames(block, downsample, out_dtype)
+
+            if output.endswith('.h5'):
+                if store is None:
+                    from preprocessing.store import VIDEO, append_frames, create_dataset, open_store
+                    store = open_store(output, 'a')
+                    dataset = create_dataset(store, VIDEO, (0,) + block.shape[1:], out_dtype,
+                                             maxshape=(None,) + block.shape[1:])
+                append_frames(dataset, block)
+            else:
+                if writer is None:
+                    import tifffile
+                    writer = tifffile.TiffWriter(output, bigtiff=True)
+                # writing frame by frame in contiguous mode keeps every page in one uncompressed series (even when the
+                # last block is short), so preprocessing.frame_source can memory map the result as a single stack
+                for frame in block:
+                    writer.write(frame, contiguous=True, photometric='minisblack')
+
+            n_frames += len(block)
+    finally:
+        if writer is not None:
+            writer.close()
+        if store is not None:
+            store.close()
+
+    return n_frames
+
+
+def convert_mj2(fn, output, chunk_size=CHUNK_SIZE, downsample=1, dtype=None, ffmpeg_path=FFMPEG_PATH):
+    '''
+    Convert one .mj2 to a BigTIFF / store without decoding the whole video at once.
+    '''
+    return write_frames(read_mj2_frames(fn, ffmpeg_path), output, chunk_size=chunk_size, downsample=downsample, dtype=dtype)
+
+
+def convert_batch(files, output_dir, extension='.tif', workers=None, **kwargs):
+    '''
+    Convert several .mj2 files in parallel, one file per process.
+    @Return: dict of {input file: number of frames written}.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {fn: os.path.join(output_dir, os.path.splitext(os.path.basename(fn))[0] + extension) for fn in files}
+
+    n_frames = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convert_mj2, fn, outputs[fn], **kwargs): fn for fn in files}
+        for future in as_completed(futures):
+            fn = futures[future]
+            n_frames[fn] = future.result()
+            print('Converted ' + fn + ' -> ' + outputs[fn] + ' (' + str(n_frames[fn]) + ' frames)')
+    return n_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream .mj2 videos into BigTIFF stacks (or widefield.h5 stores)')
+    parser.add_argument('files', nargs='+', help='.mj2 files to convert')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--format', choices=['tif', 'h5'], default='tif')
+    parser.add_argument('--downsample', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--ffmpeg-path', default=FFMPEG_PATH)
+    args = parser.parse_args()
 
-outputparameters = {'-pix_fmt' : 'gray16be'} # specify to import as uint16, otherwise it's uint8
+    convert_batch(args.files, args.output_dir, extension='.' + args.format, workers=args.workers,
+                  chunk_size=args.chunk_size, downsample=args.downsample, ffmpeg_path=args.ffmpeg_path)
 
-vid = np.squeeze(skvideo.io.vread(fn,outputdict=outputparameters)) #  Read in video as numpy array 
 
-tifffile.imwrite('temp.tif',vid, photometric='minisblack')   #  Write as TIFF, change 'temp.tif' to desired filename
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''
+Loading config_widefield.json.
+
+The scripts all read ../../config_widefield.json (two folders above this one).  load_config reads the same file (or any
+other path) and fills in defaults for the keys added by the newer pipeline stages, so older config files keep working.
+
+Nothing reads the config at import time.  Functions that need config values take a config=None argument and resolve it
+with get_config: a config passed explicitly is used (with DEFAULTS filled in, so e.g. a plain json.load of an older file
+works too), otherwise config_widefield.json is read once, on first use.  Together with matplotlib / scipy / skimage /
+tifffile being imported by the functions that use them, this keeps the scripts importable from notebooks and batch
+workers without a config file.
+'''
+
+import json
+import os
+
+CONFIG_PATH = os.path.abspath(os.path.dirname(__file__)) + '/../../config_widefield.json'
+
+# Defaults for keys that older config_widefield.json files won't have.
+DEFAULTS = {
+    'DownsampleFactor': 2, # spatial block size; 2 for 512x512 -> 256x256, 4 for 1024x1024 sensors
+    'DownsampleDtype': 'float32', # dtype of the downsampled video: 'float32' or 'uint16'
+}
+
+
+def load_config(path=None):
+    '''
+    Read config_widefield.json.
+    @Param path: path of the config file, defaults to ../../config_widefield.json relative to this folder.
+    @Return: dict of config values, with DEFAULTS filled in for any missing keys.
+    '''
+    with open(path or CONFIG_PATH, 'r') as f:
+        config = json.load(f)
+    return {**DEFAULTS, **config}
+
+
+_default_config = {}
+
+
+def get_config(config=None):
+    '''
+    The config a function should use: config if one was passed, otherwise load_config() (read once and reused).
+    DEFAULTS are filled in for any keys a passed config is missing.
+    '''
+    if config is not None:
+        return {**DEFAULTS, **config}
+    if CONFIG_PATH not in _default_config:
+        _default_config[CONFIG_PATH] = load_config()
+    return _default_config[CONFIG_PATH]
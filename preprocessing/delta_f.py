@@ -0,0 +1,141 @@
+'''
+Vectorized, streaming ΔF/F0.
+
+convert_deltaF_F0 / get_pixel_baseline (widefield_pre_process, plot_tonotopic_map_basics and test_deconvolution notebooks)
+looped over all 256x256 pixels and, for each, sliced the 5 pre-onset frames of every trial and averaged them in Python;
+convert_to_deltaF_Fo_singlemean did a 256x256 loop for the session mean.  Here F0 is computed for all pixels at once, with
+a choice of baseline:
+    - 'trial':      mean over trials of the mean of the n_baseline_frames frames before each onset (get_pixel_baseline).
+                    Each trial's window is turned into per-frame weights once, so F0 is a weighted sum over just the
+                    baseline frames, read a chunk at a time.
+    - 'mean':       whole-session mean of each pixel (convert_to_deltaF_Fo_singlemean), accumulated over frame chunks.
+    - 'percentile': a low percentile of each pixel's whole trace - a baseline that ignores responses without needing
+                    onsets.  A percentile needs the full trace of a pixel, so the recording is read once in chunks of
+                    frames into pixel-major traces (frame_source.pixel_traces) and the percentiles are taken a band of
+                    pixels at a time.
+(F - F0) / F0 is then applied in a second streaming pass over frame chunks, so memory stays at one chunk.
+'''
+
+import numpy as np
+
+from preprocessing.frame_source import pixel_traces
+
+DEFAULT_CHUNK_SIZE = 256 # frames per chunk
+N_BASELINE_FRAMES = 5 # pre-onset frames per trial, as get_pixel_baseline used
+DEFAULT_PERCENTILE = 10
+BAND_BYTES = 1 << 28 # ~256 MB of float64 trace data per band of pixels for the percentile baseline
+
+
+def trial_baseline_weights(onset_frames, n_frames, n_baseline_frames=N_BASELINE_FRAMES):
+    '''
+    Per-frame weights that turn the trial-locked baseline into one weighted sum over frames.
+    Each trial's window is frames [onset - n_baseline_frames, onset) (clipped to the recording, onset frame excluded); its
+    frames get 1 / window length, and trials are averaged with equal weight, exactly as get_pixel_baseline averaged the
+    per-trial means.  Trials whose window is empty (onset at frame 0 or past the end) are skipped rather than turning the
+    whole baseline into NaN.
+    @Return: N_frames float64 array of weights summing to 1.
+    '''
+    onsets = np.asarray(onset_frames, dtype=float)
+    starts = np.clip(np.maximum(onsets - n_baseline_frames, 0).astype(np.intp), 0, n_frames)
+    stops = np.clip(onsets.astype(np.intp), 0, n_frames)
+    lengths = stops - starts
+    keep = lengths > 0
+    if not keep.any():
+        raise ValueError('no trial has any baseline frames inside the recording')
+    starts, stops, lengths = starts[keep], stops[keep], lengths[keep]
+
+    # add 1/length over each window with a difference array, then integrate
+    steps = np.zeros(n_frames + 1)
+    np.add.at(steps, starts, 1 / lengths)
+    np.add.at(steps, stops, -1 / lengths)
+    return np.cumsum(steps[:-1]) / len(lengths)
+
+
+def _trial_f0(video, onset_frames, n_baseline_frames, chunk_size):
+    weights = trial_baseline_weights(onset_frames, len(video), n_baseline_frames)
+    frames = np.flatnonzero(weights)
+    f0 = np.zeros(tuple(video.shape[1:]))
+    for k in range(0, len(frames), chunk_size):
+        idx = frames[k:k + chunk_size]
+        block = np.asarray(video[idx])
+        f0 += np.tensordot(weights[idx], block, axes=(0, 0))
+    return f0
+
+
+def _mean_f0(video, chunk_size):
+    total = np.zeros(tuple(video.shape[1:]))
+    for start in range(0, len(video), chunk_size):
+        total += np.asarray(video[start:start + chunk_size]).sum(axis=0, dtype=np.float64)
+    return total / len(video)
+
+
+def _percentile_f0(video, percentile, chunk_size):
+    with pixel_traces(video, chunk_size) as traces:
+        band = max(1, BAND_BYTES // max(1, len(video) * 8))
+        f0 = np.empty(len(traces))
+        for p in range(0, len(traces), band):
+            f0[p:p + band] = np.percentile(traces[p:p + band], percentile, axis=1)
+    return f0.reshape(tuple(video.shape[1:]))
+
+
+def compute_f0(video, baseline='trial', onset_frames=None, n_baseline_frames=N_BASELINE_FRAMES,
+               percentile=DEFAULT_PERCENTILE, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Baseline fluorescence F0 of every pixel.
+    @Param video: N_frames x N_pixels x N_pixels array, memmap, FrameSource or HDF5 dataset.
+    @Param baseline: 'trial' (needs onset_frames), 'mean' or 'percentile'.
+    @Param onset_frames: stimulus onsets in frames (from get_onset_frames).
+    @Return: N_pixels x N_pixels float64 array.
+    '''
+    if baseline == 'trial':
+        if onset_frames is None:
+            raise ValueError("baseline='trial' needs onset_frames")
+        return _trial_f0(video, onset_frames, n_baseline_frames, chunk_size)
+    if baseline == 'mean':
+        return _mean_f0(video, chunk_size)
+    if baseline == 'percentile':
+        return _percentile_f0(video, percentile, chunk_size)
+    raise ValueError("baseline must be 'trial', 'mean' or 'percentile', not %r" % (baseline,))
+
+
+def iter_delta_f(video, f0, chunk_size=DEFAULT_CHUNK_SIZE, dtype=None):
+    '''
+    (F - F0) / F0 for every frame, chunk by chunk.
+    @Param dtype: output dtype, defaults to the video's dtype if it is floating point, float32 otherwise.
+    @Return: generator of (first_frame_index, ΔF/F0 chunk) in frame order.
+    '''
+    if dtype is None:
+        dtype = video.dtype if np.dtype(video.dtype).kind == 'f' else np.float32
+    inverse_f0 = 1 / f0
+    for start in range(0, len(video), chunk_size):
+        chunk = np.asarray(video[start:start + chunk_size])
+        yield start, ((chunk - f0) * inverse_f0).astype(dtype, copy=False)
+
+
+def delta_f_over_f(video, baseline='trial', onset_frames=None, out=None, n_baseline_frames=N_BASELINE_FRAMES,
+                   percentile=DEFAULT_PERCENTILE, chunk_size=DEFAULT_CHUNK_SIZE, dtype=None, return_f0=False):
+    '''
+    Convert a recording to ΔF/F0 (see compute_f0 for the baseline options).  The input is not modified.
+    @Param out: optional preallocated N_frames x N_pixels x N_pixels array (e.g. a memmap or HDF5 dataset) to write into.
+    @Return: ΔF/F0 video (out, if given), or (video, f0) if return_f0.
+    '''
+    f0 = compute_f0(video, baseline, onset_frames, n_baseline_frames, percentile, chunk_size)
+    for start, chunk in iter_delta_f(video, f0, chunk_size, dtype):
+        if out is None:
+            out = np.empty((len(video),) + chunk.shape[1:], dtype=chunk.dtype)
+        out[start:start + len(chunk)] = chunk
+    return (out, f0) if return_f0 else out
+
+
+def convert_deltaF_F0(video, onset_frames):
+    '''
+    Drop-in for the notebooks' convert_deltaF_F0: trial-locked F0 from the 5 frames before each onset.
+    '''
+    return delta_f_over_f(video, 'trial', onset_frames)
+
+
+def convert_to_deltaF_Fo_singlemean(video):
+    '''
+    Drop-in for the notebooks' convert_to_deltaF_Fo_singlemean: F0 is the whole-session mean of each pixel.
+    '''
+    return delta_f_over_f(video, 'mean')
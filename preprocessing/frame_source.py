@@ -0,0 +1,289 @@
+'''
+Lazy, memory-mapped access to widefield recordings.
+
+load_recording used to imread every file in the recording folder, append each downsampled frame to a list and then copy
+the list into one big array, so peak memory was roughly twice the size of the video.  The frame sources below open the
+recording without reading any pixel data.  Frames are only decoded (and downsampled) when a later stage indexes them or
+iterates over them in chunks, so memory scales with the chunk size rather than with the length of the recording.
+
+Two layouts are supported:
+    - a single multi-page TIFF stack (e.g. the output of Trenholm_MJ_to_TIFF.py)
+    - a folder of TIFFs, either one file per frame (camera output) or several multi-page stacks
+'''
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from preprocessing.downsample import DEFAULT_DTYPE, downsample_frames
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+DEFAULT_CHUNK_SIZE = 256 # frames per chunk when iterating over a recording
+TRACES_IN_MEMORY_BYTES = 1 << 28 # pixel_traces copies up to ~256 MB are kept in memory, larger ones go to a temp file
+
+
+def list_tiffs(folder):
+    '''
+    Return the full paths of the TIFF files in a folder, in sorted filename order.
+    Anything that isn't a TIFF (the trigger CSV, pickles, etc.) is ignored, so the recording no longer has to be the only
+    thing in the folder.
+    '''
+    names = sorted(name for name in os.listdir(folder) if name.lower().endswith(TIFF_EXTENSIONS))
+    return [os.path.join(folder, name) for name in names]
+
+
+def _memmap_or_read(path):
+    # Uncompressed, contiguous TIFFs can be mapped straight from disk.  Anything else (compressed, tiled, strips with
+    # gaps) has to be decoded.
+    import tifffile
+
+    try:
+        return tifffile.memmap(path, mode='r')
+    except ValueError:
+        return tifffile.imread(path)
+
+
+def _count_pages(path):
+    import tifffile
+
+    with tifffile.TiffFile(path) as tif:
+        return len(tif.pages)
+
+
+class FrameSource:
+    '''
+    Base class for lazy recordings.  Subclasses implement _read(start, stop), which returns raw frames [start, stop) as an
+    (n_frames x height x width) array.
+
+    Indexing behaves like a numpy array of shape (n_frames x height x width): source[10:20,:,:], source[5],
+    source[onsets] all work and return ndarrays, but only the frames asked for are read from disk.
+    @Param downsample: block size used to spatially downsample each frame (2 turns 512x512 into 256x256).  1 = no downsampling.
+    @Param dtype: dtype of the frames handed out.  Defaults to float32 when downsampling, otherwise the file's dtype.
+    '''
+
+    def __init__(self, n_frames, raw_shape, raw_dtype, downsample=1, dtype=None):
+        self.n_frames = n_frames
+        self.raw_shape = tuple(raw_shape)
+        self.raw_dtype = np.dtype(raw_dtype)
+        self.downsample = int(downsample)
+
+        if self.downsample > 1:
+            self.frame_shape = tuple(-(-n // self.downsample) for n in self.raw_shape)
+            self.dtype = np.dtype(DEFAULT_DTYPE if dtype is None else dtype)
+        else:
+            self.frame_shape = self.raw_shape
+            self.dtype = self.raw_dtype if dtype is None else np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return (self.n_frames,) + self.frame_shape
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __len__(self):
+        return self.n_frames
+
+    def _read(self, start, stop):
+        raise NotImplementedError
+
+    def _read_indices(self, indices):
+        # Default gather: read each contiguous run of requested frames in one go.
+        indices = np.asarray(indices, dtype=np.intp)
+        out = np.empty((len(indices),) + self.raw_shape, dtype=self.raw_dtype)
+        if len(indices) == 0:
+            return out
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        for run in np.split(np.arange(len(indices)), breaks):
+            start = indices[run[0]]
+            out[run] = self._read(start, start + len(run))
+        return out
+
+    def _reduce(self, frames):
+        # whole blocks of frames are downsampled in one vectorized pass
+        return downsample_frames(frames, self.downsample, self.dtype)
+
+    def read(self, start, stop):
+        '''
+        Read (and downsample) frames [start, stop) into memory.
+        '''
+        start, stop, _ = slice(start, stop).indices(self.n_frames)
+        if stop <= start:
+            return np.empty((0,) + self.frame_shape, dtype=self.dtype)
+        return self._reduce(np.asarray(self._read(start, stop)))
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE, start=0, stop=None):
+        '''
+        Iterate over the recording in blocks of frames.
+        @Param chunk_size: number of frames per block.
+        @Return: generator of (first_frame_index, chunk) where chunk is a (n_frames x height x width) array.
+        '''
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            yield chunk_start, self.read(chunk_start, chunk_stop)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, pixel_key = key[0], key[1:]
+        single_frame = False
+
+        if isinstance(frame_key, slice):
+            start, stop, step = frame_key.indices(self.n_frames)
+            if step == 1:
+                frames = self.read(start, stop)
+            else:
+                frames = self._reduce(self._read_indices(np.arange(start, stop, step)))
+        elif np.ndim(frame_key) == 0:
+            index = int(frame_key)
+            if index < 0:
+                index += self.n_frames
+            if not 0 <= index < self.n_frames:
+                raise IndexError('frame index %d is out of range for a recording of %d frames' % (frame_key, self.n_frames))
+            frames = self.read(index, index + 1)[0]
+            single_frame = True
+        else:
+            indices = np.arange(self.n_frames)[np.asarray(frame_key)]
+            frames = self._reduce(self._read_indices(indices))
+
+        if pixel_key:
+            # an integer frame key has already consumed the frame axis, so only the pixel axes are left to index
+            frames = frames[pixel_key] if single_frame else frames[(slice(None),) + pixel_key]
+        return frames
+
+    def __array__(self, dtype=None, copy=None):
+        video = self.read(0, self.n_frames)
+        return video if dtype is None else video.astype(dtype, copy=False)
+
+
+class TiffStackSource(FrameSource):
+    '''
+    A single multi-page TIFF stack.  Uncompressed stacks are memory mapped; anything else is decoded page by page on demand.
+    '''
+
+    def __init__(self, path, downsample=1, dtype=None):
+        import tifffile
+
+        self.path = path
+        self._tif = None
+        self._pages = None
+        try:
+            self._stack = tifffile.memmap(path, mode='r')
+        except ValueError:
+            self._stack = None
+
+        if self._stack is not None:
+            # flatten any leading axes (e.g. stacks appended in blocks by the MJ2 converter) into one frame axis
+            stack = self._stack.reshape((-1,) + self._stack.shape[-2:])
+            self._stack = stack
+            n_frames, raw_shape, raw_dtype = stack.shape[0], stack.shape[1:], stack.dtype
+        else:
+            self._tif = tifffile.TiffFile(path)
+            self._pages = self._tif.series[0].pages
+            first = self._pages[0]
+            n_frames, raw_shape, raw_dtype = len(self._pages), first.shape, first.dtype
+
+        super().__init__(n_frames, raw_shape, raw_dtype, downsample, dtype)
+
+    def _read(self, start, stop):
+        if self._stack is not None:
+            return self._stack[start:stop]
+        return np.stack([self._pages[i].asarray() for i in range(start, stop)])
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+
+
+class TiffFolderSource(FrameSource):
+    '''
+    A folder of TIFF files, read in sorted filename order.  Usually this is one file per frame, but a recording split
+    across several multi-page stacks works too.
+    '''
+
+    def __init__(self, folder, downsample=1, dtype=None):
+        self.folder = folder
+        self.files = list_tiffs(folder)
+        if not self.files:
+            raise FileNotFoundError('No TIFF files found in ' + str(folder))
+
+        first = _memmap_or_read(self.files[0])
+        if first.ndim == 2:
+            # One frame per file - don't open every file just to count pages.
+            frames_per_file = np.ones(len(self.files), dtype=np.intp)
+            raw_shape = first.shape
+        else:
+            frames_per_file = np.array([_count_pages(f) for f in self.files], dtype=np.intp)
+            raw_shape = first.shape[1:]
+
+        # file_starts[k] is the index of the first frame stored in self.files[k]
+        self.file_starts = np.concatenate(([0], np.cumsum(frames_per_file)))
+        super().__init__(int(self.file_starts[-1]), raw_shape, first.dtype, downsample, dtype)
+
+    def _read(self, start, stop):
+        out = np.empty((stop - start,) + self.raw_shape, dtype=self.raw_dtype)
+        first_file = np.searchsorted(self.file_starts, start, side='right') - 1
+        last_file = np.searchsorted(self.file_starts, stop, side='left')
+
+        for k in range(first_file, last_file):
+            file_start, file_stop = self.file_starts[k], self.file_starts[k + 1]
+            lo, hi = max(start, file_start), min(stop, file_stop)
+            frames = _memmap_or_read(self.files[k])
+            if frames.ndim == 2:
+                frames = frames[np.newaxis]
+            out[lo - start:hi - start] = frames[lo - file_start:hi - file_start]
+        return out
+
+
+def open_recording(path, downsample=1, dtype=None):
+    '''
+    Open a recording lazily.  Nothing is decoded until frames are indexed or iterated over.
+    @Param path: a multi-page TIFF file, or a folder of TIFFs.
+    @Param downsample: spatial block size (2 for 512x512 -> 256x256), usually config['DownsampleFactor'].
+    @Param dtype: output dtype ('float32' or 'uint16'), usually config['DownsampleDtype'].
+    @Return: a FrameSource.
+    '''
+    if os.path.isdir(path):
+        return TiffFolderSource(path, downsample=downsample, dtype=dtype)
+    return TiffStackSource(path, downsample=downsample, dtype=dtype)
+
+
+@contextmanager
+def pixel_traces(video, chunk_size=DEFAULT_CHUNK_SIZE, max_memory_bytes=TRACES_IN_MEMORY_BYTES):
+    '''
+    The recording transposed to pixel-major order, for stages that need whole pixel traces (percentiles, deconvolution).
+    Slicing a band of rows out of a FrameSource decodes every frame, so reading a recording band by band would read it
+    once per band; here it is read once, in chunks of frames, and each chunk is scattered into the traces.
+    @Param video: N_frames x N_pixels x N_pixels array, memmap, FrameSource or HDF5 dataset.
+    @Param max_memory_bytes: larger copies are written to a temporary memmap, deleted when the with block exits.
+    @Return: context manager giving an (N_pixels * N_pixels) x N_frames array in the video's dtype; row p is the trace of
+    flat pixel p (row * width + column).
+    '''
+    n_frames, n_pixels = len(video), int(np.prod(video.shape[1:]))
+    dtype = np.dtype(video.dtype)
+    with tempfile.TemporaryFile() as f:
+        if n_pixels * n_frames * dtype.itemsize <= max_memory_bytes:
+            traces = np.empty((n_pixels, n_frames), dtype=dtype)
+        else:
+            traces = np.memmap(f, dtype=dtype, mode='w+', shape=(n_pixels, n_frames))
+        for start in range(0, n_frames, chunk_size):
+            chunk = np.asarray(video[start:start + chunk_size])
+            traces[:, start:start + len(chunk)] = chunk.reshape(len(chunk), n_pixels).T
+        yield traces
+        del traces
+
+
+'''
+Drop-in replacement for the old load_recording(TIFF).  Returns a lazy FrameSource rather than a fully loaded array - index
+it like the old array (video[start:stop,:,:]) and only those frames are read.  Call np.asarray(video) if the whole thing
+really is needed in memory.
+@Param: Path of the recording folder (or multi-page TIFF).
+Return: (N_frames x N_pixels x N_pixels) FrameSource.
+'''
+def load_recording(TIFF, downsample=2, dtype=None):
+    return open_recording(TIFF, downsample=downsample, dtype=dtype)
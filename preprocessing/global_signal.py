@@ -0,0 +1,102 @@
+'''
+Streaming global-signal regression.
+
+regress_out_global_flucts (plot_tonotopic_map_basics / test_deconvolution notebooks) fitted an sklearn LinearRegression
+with the frame-averaged intensity as the regressor and all 65,536 pixels as targets, and held y, predict and corrected as
+full float64 copies of the video.  With a single regressor the least-squares fit has a closed form per pixel:
+
+    slope     = cov(global, pixel) / var(global)
+    intercept = mean(pixel) - slope * mean(global)
+
+which only needs running sums over frames.  fit_global_regression accumulates them in one pass over chunks of frames, and
+iter_regress_out applies the correction in a second streaming pass, so peak memory is one chunk (plus the per-pixel sums).
+The sums are taken around a shift (the first chunk's means) to avoid the cancellation the textbook sum-of-squares formula
+suffers from for bright, slowly varying recordings.
+'''
+
+from collections import namedtuple
+
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 256 # frames per chunk
+
+GlobalFit = namedtuple('GlobalFit', ['slope', 'intercept', 'global_signal'])
+
+
+def _chunks(video, chunk_size):
+    for start in range(0, len(video), chunk_size):
+        yield start, np.asarray(video[start:start + chunk_size])
+
+
+def fit_global_regression(video, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Per-pixel least-squares fit of every pixel trace against the global (frame-averaged) signal, in one pass.
+    @Param video: N_frames x N_pixels x N_pixels array, memmap, FrameSource or HDF5 dataset.
+    @Return: GlobalFit(slope, intercept, global_signal) - N_pixels x N_pixels slope and intercept maps, and the
+    N_frames global signal used as the regressor.
+    '''
+    n_frames = len(video)
+    frame_shape = tuple(video.shape[1:])
+    global_signal = np.empty(n_frames)
+
+    shift_g = shift_y = None
+    sum_g = sum_gg = 0.0
+    sum_y = sum_gy = None
+    for start, chunk in _chunks(video, chunk_size):
+        traces = chunk.reshape(len(chunk), -1)
+        g = traces.mean(axis=1, dtype=np.float64)
+        global_signal[start:start + len(g)] = g
+
+        if shift_g is None:
+            shift_g = g.mean()
+            shift_y = traces.mean(axis=0, dtype=np.float64)
+            sum_y = np.zeros_like(shift_y)
+            sum_gy = np.zeros_like(shift_y)
+        dg = g - shift_g
+        dy = traces - shift_y # float64
+        sum_g += dg.sum()
+        sum_gg += dg @ dg
+        sum_y += dy.sum(axis=0)
+        sum_gy += dg @ dy
+
+    mean_g = sum_g / n_frames
+    mean_y = sum_y / n_frames
+    var_g = sum_gg / n_frames - mean_g ** 2
+    cov_gy = sum_gy / n_frames - mean_g * mean_y
+    slope = cov_gy / var_g if var_g > 0 else np.zeros_like(cov_gy) # a constant global signal explains nothing
+    intercept = (mean_y + shift_y) - slope * (mean_g + shift_g)
+    return GlobalFit(slope.reshape(frame_shape), intercept.reshape(frame_shape), global_signal)
+
+
+def iter_regress_out(video, fit=None, chunk_size=DEFAULT_CHUNK_SIZE, dtype=None):
+    '''
+    Subtract the fitted global-signal component from every pixel, chunk by chunk.
+    @Param fit: GlobalFit from fit_global_regression (computed here if not given).
+    @Param dtype: output dtype, defaults to the video's dtype if it is floating point, float32 otherwise.
+    @Return: generator of (first_frame_index, corrected chunk) in frame order.
+    '''
+    if fit is None:
+        fit = fit_global_regression(video, chunk_size)
+    if dtype is None:
+        dtype = video.dtype if np.dtype(video.dtype).kind == 'f' else np.float32
+
+    for start, chunk in _chunks(video, chunk_size):
+        g = fit.global_signal[start:start + len(chunk), np.newaxis, np.newaxis]
+        corrected = chunk - (fit.intercept + fit.slope * g)
+        yield start, corrected.astype(dtype, copy=False)
+
+
+def regress_out_global_flucts(video, out=None, chunk_size=DEFAULT_CHUNK_SIZE, dtype=None, return_fit=False):
+    '''
+    Remove global fluctuations from a recording (replaces the notebooks' sklearn version).
+    @Param video: N_frames x N_pixels x N_pixels recording (not modified).
+    @Param out: optional preallocated N_frames x N_pixels x N_pixels array (e.g. a memmap or HDF5 dataset) to write into.
+    @Param return_fit: also return the GlobalFit (slope / intercept maps and the global signal).
+    @Return: corrected video (out, if given), or (corrected video, fit).
+    '''
+    fit = fit_global_regression(video, chunk_size)
+    for start, chunk in iter_regress_out(video, fit, chunk_size, dtype):
+        if out is None:
+            out = np.empty((len(video),) + chunk.shape[1:], dtype=chunk.dtype)
+        out[start:start + len(chunk)] = chunk
+    return (out, fit) if return_fit else out
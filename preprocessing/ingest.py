@@ -0,0 +1,135 @@
+'''
+Parallel ingest of a recording: TIFF decode and spatial downsampling spread across a thread or process pool.
+
+The recording is cut into blocks of consecutive frames and each block is decoded + block-reduced by a pool worker.  At
+most max_pending blocks are in flight at any time (bounded backpressure), so a slow consumer - e.g. writing to disk -
+never lets decoded frames pile up in memory.  Blocks are always handed back in frame order, which is sorted filename order
+for per-frame folders (os.listdir order is arbitrary and differs between machines).
+
+Usage (from the top of the repository):
+    python -m preprocessing.ingest <recording folder or .tif> <output.npy> [--downsample 2] [--workers 16] [--processes]
+The downsampling factor and dtype default to DownsampleFactor / DownsampleDtype in config_widefield.json.
+'''
+
+import argparse
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+
+from preprocessing.config import CONFIG_PATH, DEFAULTS, load_config
+from preprocessing.frame_source import open_recording
+
+DEFAULT_BLOCK_SIZE = 32 # frames decoded per pool task
+
+# Each worker (thread or process) keeps its own open FrameSource, so file handles are never shared between workers and
+# the TIFF headers are only parsed once per worker.
+_worker_state = threading.local()
+
+
+def _worker_source(path, downsample, dtype):
+    sources = getattr(_worker_state, 'sources', None)
+    if sources is None:
+        sources = _worker_state.sources = {}
+    key = (path, downsample, dtype)
+    if key not in sources:
+        sources[key] = open_recording(path, downsample=downsample, dtype=dtype)
+    return sources[key]
+
+
+def _decode_block(path, downsample, dtype, start, stop):
+    return _worker_source(path, downsample, dtype).read(start, stop)
+
+
+def iter_ingest(path, downsample=1, dtype=None, block_size=DEFAULT_BLOCK_SIZE, workers=None, use_processes=False,
+                max_pending=None):
+    '''
+    Decode and downsample a recording in parallel, yielding blocks of frames in order.
+    @Param path: folder of TIFFs or a multi-page TIFF.
+    @Param downsample: spatial block size (2 for 512x512 -> 256x256).
+    @Param dtype: output dtype of the downsampled frames ('float32' or 'uint16').
+    @Param block_size: frames per pool task.
+    @Param workers: pool size, defaults to the number of cores.
+    @Param use_processes: use a process pool instead of threads (helps when decode holds the GIL, e.g. some compressions).
+    @Param max_pending: maximum number of blocks decoded ahead of the consumer, defaults to 2 x workers.
+    @Return: generator of (first_frame_index, block) in frame order.
+    '''
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    n_frames = len(open_recording(path, downsample=downsample, dtype=dtype))
+
+    pool_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_type(max_workers=workers) as pool:
+        pending = deque()
+        starts = iter(range(0, n_frames, block_size))
+
+        # prime the pool, then submit one new block for every block handed back
+        for start in starts:
+            pending.append((start, pool.submit(_decode_block, path, downsample, dtype, start,
+                                               min(start + block_size, n_frames))))
+            if len(pending) >= max_pending:
+                break
+
+        while pending:
+            start, future = pending.popleft()
+            block = future.result()
+            next_start = next(starts, None)
+            if next_start is not None:
+                pending.append((next_start, pool.submit(_decode_block, path, downsample, dtype, next_start,
+                                                        min(next_start + block_size, n_frames))))
+            yield start, block
+
+
+def ingest_recording(path, downsample=2, dtype=None, out=None, **kwargs):
+    '''
+    Load a whole recording with the parallel engine.  The output is allocated once and filled block by block, unlike the old
+    list-then-np.array load_recording which held two copies of the video.
+    @Param out: optional preallocated (N_frames x N_pixels x N_pixels) array to fill, e.g. np.lib.format.open_memmap() or an
+    HDF5 dataset, so the video never has to be held in RAM.
+    @Return: (N_frames x N_pixels x N_pixels) array (out, if given).
+    '''
+    source = open_recording(path, downsample=downsample, dtype=dtype)
+    if out is None:
+        out = np.empty(source.shape, dtype=source.dtype)
+    elif tuple(out.shape) != source.shape:
+        raise ValueError('out has shape %s but the recording is %s' % (tuple(out.shape), source.shape))
+
+    for start, block in iter_ingest(path, downsample=downsample, dtype=dtype, **kwargs):
+        out[start:start + len(block)] = block
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode and downsample a recording in parallel and save it as .npy')
+    parser.add_argument('recording', help='folder of TIFFs or multi-page TIFF')
+    parser.add_argument('output', help='.npy file to write')
+    parser.add_argument('--config', default=None, help='config_widefield.json to take DownsampleFactor/DownsampleDtype from')
+    parser.add_argument('--downsample', type=int, default=None, help='overrides DownsampleFactor')
+    parser.add_argument('--dtype', default=None, help='overrides DownsampleDtype (float32 or uint16)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--processes', action='store_true', help='use a process pool instead of threads')
+    args = parser.parse_args()
+
+    if args.downsample is None or args.dtype is None:
+        config = load_config(args.config) if args.config or os.path.exists(CONFIG_PATH) else DEFAULTS
+        args.downsample = args.downsample or config['DownsampleFactor']
+        args.dtype = args.dtype or config['DownsampleDtype']
+
+    start_time = time.monotonic()
+    source = open_recording(args.recording, downsample=args.downsample, dtype=args.dtype)
+    out = np.lib.format.open_memmap(args.output, mode='w+', dtype=source.dtype, shape=source.shape)
+    ingest_recording(args.recording, downsample=args.downsample, dtype=args.dtype, out=out, block_size=args.block_size,
+                     workers=args.workers, use_processes=args.processes)
+    out.flush()
+
+    end_time = time.monotonic()
+    print('Ingested %d frames in %s' % (len(source), timedelta(seconds=end_time - start_time)))
+
+
+if __name__ == '__main__':
+    main()
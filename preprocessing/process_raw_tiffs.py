@@ -1,15 +1,17 @@
 
-from skimage.io import imread
-from skimage.measure import block_reduce
-from skimage import restoration
 import numpy as np
-import os
-import matplotlib.pyplot as plt
 
+from preprocessing import triggers
+from preprocessing.deconvolution import deconvolve
+from preprocessing.frame_source import open_recording
+
+DOWNSAMPLE_FACTOR = 8 # 8x8 blocks, e.g. 512x512 -> 64x64
 TRIGGER_DELAY_IN_MS  = 0
 RECORDING_FRAMERATE = 10
 EPOCH_END_IN_MS = 1000
 EPOCH_START_IN_MS = 0
+RL_MAX_ITER = 200 # Richardson-Lucy iteration limit (the old fixed count)
+RL_TOL = 1e-3 # stop a frame once its estimate changes by less than this (relative) per iteration; 0 = always RL_MAX_ITER
 
 """
 Find the stimulus onsets from the trigger CSV and define as frames in the fluorescence recording
@@ -17,35 +19,9 @@ Find the stimulus onsets from the trigger CSV and define as frames in the fluore
 @return onset_frames_at_recording_fr: a list of the frames in the fluo recording where the stim was presented
 """
 def get_onset_frames(stimulus):
-    # find the max voltage (this will be the value in the vector when the trigger was sent)
-    max_voltage = max(stimulus, key=lambda x:x[1])
-    max_voltage = max_voltage[1]
-
-    onset_times = [] # empty list to append our onset frames into
-    time_list_index = 0 # counter to keep track of our index in the onset_times list
-
-    # for each frame in the stimulus file
-    for stimulus_idx in range(len(stimulus)):
-        (time,voltage) = stimulus[stimulus_idx] # unpack the voltage at that timepoint
-
-        if voltage.round() == max_voltage.round(): # if the voltage was our trigger voltage
-            if time_list_index == 0: # and if we're at the first index (so there's no previous index to compare with)
-                trigger_time_in_sec = time/1000 + TRIGGER_DELAY_IN_MS/1000
-                onset_times.append(trigger_time_in_sec) # add the time as an onset time in SECONDS
-                time_list_index += 1
-
-            # if we're not at index zero, we need to compare this voltage with the previous saved onset voltage
-            # otherwise we save a bunch of voltages as separate triggers because they all match the max voltage
-            # but we just want one timepoint per trigger
-            elif time/1000 -  onset_times[time_list_index - 1] > 1: 
-                trigger_time_in_sec = time/1000 + TRIGGER_DELAY_IN_MS/1000
-                onset_times.append(trigger_time_in_sec) # want it in second not millisecond
-                time_list_index += 1
-
-    # get the onset times in terms of frames of our fluorescence trace
-    onset_frames_at_recording_fr = np.multiply(onset_times,RECORDING_FRAMERATE) # s * f/s = f
-
-    return onset_frames_at_recording_fr # a list of stimulus onsets in units of frames at recording framerate
+    # vectorized trigger detection shared by all the scripts (preprocessing/triggers.py)
+    # this recording has no start triggers to drop
+    return triggers.get_onset_frames(stimulus,trigger_delay_in_ms=TRIGGER_DELAY_IN_MS,recording_framerate=RECORDING_FRAMERATE,n_start_triggers=0)
 
 """
 //TODO
@@ -81,22 +57,14 @@ def baseline_adjust_pixel(px,onset_frames):
 
 
 def main():
-    
+    import matplotlib.pyplot as plt
+
     folder = "/media/vtarka/USB DISK/Widefield_Test/"
-    images = [img for img in os.listdir(folder)]
 
-    trigger_csv = np.genfromtxt("/media/vtarka/USB DISK/triggers.csv",delimiter=',',skip_header=True) # voltage values of the trigger software over the recording
+    trigger_csv = triggers.read_voltage_recording("/media/vtarka/USB DISK/triggers.csv") # voltage values of the trigger software over the recording
     trigger_csv = trigger_csv[:,1:]
-    # for each image in the image folder:
-    # downsample image
-    # concatenate the downsampled image to the 3D array
-    video = []
-    for img in images:
-        im = imread(folder+img)
-        downsamp_img = block_reduce(im,block_size=(8,8),func=np.mean)
-        video.append(downsamp_img)
-
-    video = np.array(video) # transform into a 3D numpy array
+    # read every image in the folder (sorted by filename), downsampling whole blocks of frames at a time
+    video = np.asarray(open_recording(folder,downsample=DOWNSAMPLE_FACTOR)) # 3D numpy array
 
     # find the trigger frames
     onset_frames = get_onset_frames(trigger_csv)
@@ -111,9 +79,11 @@ def main():
     plt.imshow(video[0,:,:])
     plt.show()
 
+    # deconvolve batches of frames at once, each frame stopping when it has converged (at most RL_MAX_ITER iterations)
     psf = np.ones((5,5))
-    for frame in range(len(video)):
-        video[frame,:,:] = restoration.richardson_lucy(baseline_adjusted_video[frame,:,:],psf,200)
+    video, n_iter, residual = deconvolve(baseline_adjusted_video,psf,max_iter=RL_MAX_ITER,tol=RL_TOL)
+    print('Richardson-Lucy iterations per frame: median %d (%d - %d), final residual: median %.4f' %
+          (np.median(n_iter), n_iter.min(), n_iter.max(), np.nanmedian(residual)))
 
     plt.imshow(video[0,:,:])
     plt.show()
@@ -0,0 +1,89 @@
+'''
+Streaming rolling-baseline subtraction.
+
+baselinesubtract (test_deconvolution notebook) ran gaussian_filter1d, minimum_filter1d and maximum_filter1d over the whole
+float video along time, holding several full-size temporaries at once.  The baseline at frame t only depends on frames
+within a bounded distance of t:
+    - the max filter looks win frames around t (win // 2 before, the rest after)
+    - each of those looks win frames around itself in the min filter
+    - each of those looks `radius` frames either side in the Gaussian (radius = int(truncate * sigma + 0.5))
+so the video is processed in chunks of frames, each read with that many extra frames on either side (the window twice plus
+the Gaussian support).  Frames in the middle of a chunk see exactly the same inputs as in the full-array computation, and
+the ends of the recording are handled by the filters' own 'reflect' boundary, so the result is identical to the full
+computation - not an approximation - while memory stays at one (padded) chunk whatever the recording length.
+'''
+
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 1024 # frames per chunk (before the margins)
+TRUNCATE = 4.0 # gaussian_filter1d's default
+
+
+def baseline_params(sig_baseline, win_baseline, fs):
+    '''
+    Convert the notebook's parameters (seconds, Hz) to a Gaussian sigma and min/max window in frames.
+    '''
+    return sig_baseline * fs, int(win_baseline * fs)
+
+
+def baseline_margins(sigma, size, truncate=TRUNCATE):
+    '''
+    Frames needed before and after a frame to compute its baseline exactly.
+    @Return: (before, after)
+    '''
+    radius = int(truncate * float(sigma) + 0.5)
+    before = size // 2 # ndimage centres a window of `size` at size // 2
+    after = size - 1 - before
+    return 2 * before + radius, 2 * after + radius
+
+
+def rolling_baseline(frames, sigma, size, truncate=TRUNCATE):
+    '''
+    Gaussian-smoothed, then min- and max-filtered baseline along axis 0 (the notebook's computation, on one block).
+    '''
+    from scipy.ndimage import gaussian_filter1d, maximum_filter1d, minimum_filter1d
+
+    smoothed = gaussian_filter1d(frames, sigma=sigma, axis=0, truncate=truncate)
+    return maximum_filter1d(minimum_filter1d(smoothed, size=size, axis=0), size=size, axis=0)
+
+
+def iter_baseline_subtract(video, sig_baseline, win_baseline, fs, chunk_size=DEFAULT_CHUNK_SIZE, dtype=None):
+    '''
+    Subtract the rolling baseline from every pixel trace, chunk by chunk.
+    @Param video: N_frames x N_pixels x N_pixels array, memmap, FrameSource or HDF5 dataset (not modified).
+    @Param sig_baseline: Gaussian smoothing sigma in seconds.
+    @Param win_baseline: min/max window in seconds.
+    @Param fs: framerate in Hz.
+    @Param dtype: dtype the filters run in and the output is given in, defaults to the video's dtype if it is floating
+    point, float64 otherwise.
+    @Return: generator of (first_frame_index, baseline-subtracted chunk) in frame order.
+    '''
+    sigma, size = baseline_params(sig_baseline, win_baseline, fs)
+    before, after = baseline_margins(sigma, size)
+    n_frames = len(video)
+    # a chunk must be at least as long as the margins, so a 'reflect' at the end of the recording never reaches past
+    # the far side of the padded chunk
+    chunk_size = max(chunk_size, before, after, 1)
+    if dtype is None:
+        dtype = video.dtype if np.dtype(video.dtype).kind == 'f' else np.float64
+
+    for start in range(0, n_frames, chunk_size):
+        stop = min(start + chunk_size, n_frames)
+        lo, hi = max(start - before, 0), min(stop + after, n_frames)
+        frames = np.asarray(video[lo:hi], dtype=dtype)
+        baseline = rolling_baseline(frames, sigma, size)
+        keep = slice(start - lo, stop - lo)
+        yield start, frames[keep] - baseline[keep]
+
+
+def baselinesubtract(video, sig_baseline, win_baseline, fs, out=None, chunk_size=DEFAULT_CHUNK_SIZE, dtype=None):
+    '''
+    Streaming replacement for the notebook's baselinesubtract(video, sig_baseline, win_baseline, fs), same result.
+    @Param out: optional preallocated N_frames x N_pixels x N_pixels array (e.g. a memmap or HDF5 dataset) to write into.
+    @Return: baseline-subtracted video (out, if given).
+    '''
+    for start, chunk in iter_baseline_subtract(video, sig_baseline, win_baseline, fs, chunk_size, dtype):
+        if out is None:
+            out = np.empty((len(video),) + chunk.shape[1:], dtype=chunk.dtype)
+        out[start:start + len(chunk)] = chunk
+    return out
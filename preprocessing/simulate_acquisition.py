@@ -0,0 +1,93 @@
+'''
+File-drop simulator for live mode: replays a finished recording into a folder as if the camera were writing it.
+
+Frame i is written at i / framerate seconds (divided by --speed) as its own TIFF, frames/frame_000000.tif,
+frames/frame_000001.tif, ..., and every row of the trigger CSV is appended once the replay clock passes its time stamp, so
+the CSV grows alongside the frames as it does during an acquisition.  The stim_data .mat is copied in at the start.
+Every file is written under a temporary name and renamed into place, so a reader never sees a partial file.
+
+Usage (from the top of the repository), then point functional_analysis.live at the output folder:
+    python -m preprocessing.simulate_acquisition <recording folder or .tif> <trigger csv> <conditions .mat> <output folder>
+        [--framerate 10] [--speed 1]
+    python -m functional_analysis.live --set RecordingFolder=<output folder>/ TIFF=frames Triggers=<csv name>
+        Conditions=<.mat name>
+'''
+
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+
+from preprocessing import triggers
+from preprocessing.frame_source import open_recording
+
+FRAMES_FOLDER = 'frames'
+FRAME_NAME = 'frame_%06d.tif'
+PART_SUFFIX = '.part' # temporary name while a file is written; list_tiffs ignores it
+
+
+def _replace(path, write):
+    write(path + PART_SUFFIX)
+    os.replace(path + PART_SUFFIX, path)
+
+
+def simulate_acquisition(recording, trigger_csv, conditions, output, framerate=10, speed=1.0):
+    '''
+    Replay a recording into output/ in (sped up) real time.
+    @Param recording: folder of TIFFs or multi-page TIFF, replayed as it is (no downsampling).
+    @Param trigger_csv: the recording's trigger CSV (time in ms, voltage), appended to output/ row by row.
+    @Param conditions: the stim_data .mat, copied to output/ before the first frame.
+    @Param framerate: frames per second of the recording (config 'RecordingFR').
+    @Param speed: replay speed, 1 = real time.
+    @Return: number of frames written.
+    '''
+    import tifffile
+
+    frames_folder = os.path.join(output, FRAMES_FOLDER)
+    os.makedirs(frames_folder, exist_ok=True)
+    _replace(os.path.join(output, os.path.basename(conditions)), lambda path: shutil.copyfile(conditions, path))
+
+    with open(trigger_csv, 'r') as f:
+        header, *rows = f.read().splitlines(keepends=True)
+    row_times = triggers.read_voltage_recording(trigger_csv, use_cache=False)[:, 0]
+    csv_out = open(os.path.join(output, os.path.basename(trigger_csv)), 'w')
+    csv_out.write(header)
+    csv_out.flush()
+
+    video = open_recording(recording)
+    start = time.monotonic()
+    n_rows = 0
+    try:
+        for i in range(len(video)):
+            time.sleep(max(0, start + i / framerate / speed - time.monotonic()))
+            n_due = int(np.searchsorted(row_times, i * 1000 / framerate, side='right'))
+            csv_out.write(''.join(rows[n_rows:n_due]))
+            csv_out.flush()
+            n_rows = n_due
+            frame = video[i]
+            _replace(os.path.join(frames_folder, FRAME_NAME % i), lambda path: tifffile.imwrite(path, frame))
+        csv_out.write(''.join(rows[n_rows:]))
+    finally:
+        csv_out.close()
+    return len(video)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recording into a folder as if it were being acquired')
+    parser.add_argument('recording', help='folder of TIFFs or multi-page TIFF')
+    parser.add_argument('triggers', help='trigger voltage CSV')
+    parser.add_argument('conditions', help='stim_data .mat')
+    parser.add_argument('output', help='folder to write to')
+    parser.add_argument('--framerate', type=float, default=10)
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 1 = real time')
+    args = parser.parse_args()
+
+    n_frames = simulate_acquisition(args.recording, args.triggers, args.conditions, args.output, args.framerate,
+                                    args.speed)
+    print('Replayed %d frames into %s' % (n_frames, args.output))
+
+
+if __name__ == '__main__':
+    main()
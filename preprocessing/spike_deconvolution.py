@@ -0,0 +1,144 @@
+'''
+Parallel OASIS spike deconvolution of every pixel in a session (suite2p's dcnv.oasis).
+
+The notebooks called dcnv.oasis on one 1 x N_frames pixel trace at a time inside a 256x256 loop, which made a full field
+of view impractical.  Here pixel traces are handed to oasis as large 2D (pixels x time) batches: the video is read once,
+in chunks of frames, into pixel-major traces (frame_source.pixel_traces - in memory, or a temporary memmap for long
+sessions), the pixels of each band of image rows - optionally only those inside a mask - become one batch, and batches
+are deconvolved on a process pool while the next ones are being cut out.  Results are written band by band into a
+N_frames x N_pixels x N_pixels output, typically the 'spikes' dataset of the chunked store, which is created with one
+band of rows per chunk (and bands of an existing HDF5 output are aligned to its chunk rows), so every chunk is
+compressed and written once.  Pixels outside the mask are left at 0.
+
+suite2p (and its numba dependency) is only imported when this stage runs.
+'''
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from preprocessing.frame_source import pixel_traces
+from preprocessing.store import SPIKES, create_dataset, default_chunks
+
+DEFAULT_TAU = 1.5 # s, sensor timescale used in the notebooks
+DEFAULT_FS = 10 # Hz
+BATCH_BYTES = 1 << 26 # ~64 MB of float32 traces per batch
+
+
+def _dcnv():
+    try:
+        from suite2p.extraction import dcnv
+    except ImportError as e:
+        raise ImportError('Spike deconvolution needs suite2p (pip install suite2p)') from e
+    return dcnv
+
+
+def _init_worker():
+    # oasis is already numba-parallel over the traces of a batch; with one batch per process that would oversubscribe
+    # the cores, so each worker process runs numba single-threaded
+    try:
+        import numba
+        numba.set_num_threads(1)
+    except (ImportError, ValueError):
+        pass
+
+
+def _deconvolve_batch(traces, tau, fs):
+    return _dcnv().oasis(F=traces, batch_size=len(traces), tau=tau, fs=fs)
+
+
+def row_bands(video_shape, batch_bytes=BATCH_BYTES, align=1):
+    '''
+    Split the image rows into bands whose float32 traces (all frames) take about batch_bytes.
+    @Param align: band height is a multiple of this (the chunk rows of an HDF5 output), at least one multiple.
+    @Return: list of (first_row, stop_row).
+    '''
+    n_frames, height = video_shape[0], video_shape[1]
+    row_bytes = n_frames * int(np.prod(video_shape[2:])) * 4
+    band = max(1, batch_bytes // max(1, row_bytes))
+    band = max(align, band // align * align)
+    return [(r, min(r + band, height)) for r in range(0, height, band)]
+
+
+def iter_deconvolve_pixels(video, tau=DEFAULT_TAU, fs=DEFAULT_FS, mask=None, workers=None, use_processes=True,
+                           batch_bytes=BATCH_BYTES, max_pending=None, align_rows=1):
+    '''
+    Deconvolve every (masked) pixel trace, a band of image rows at a time.
+    @Param video: N_frames x N_pixels x N_pixels array, memmap, FrameSource or HDF5 dataset (ΔF/F or baseline-subtracted).
+    @Param tau: sensor timescale in s.  @Param fs: framerate in Hz.
+    @Param mask: optional N_pixels x N_pixels boolean array, only pixels where it is True are deconvolved.
+    @Param workers: pool size, defaults to the number of cores.
+    @Param use_processes: process pool (default) or threads.
+    @Param max_pending: maximum number of bands read ahead of the consumer, defaults to 2 x workers.
+    @Param align_rows: make the bands a multiple of this many rows (see row_bands).
+    @Return: generator of (first_row, stop_row, pixels, spikes) - pixels are flat indices into the band's
+    (stop_row - first_row) x N_pixels grid, spikes is len(pixels) x N_frames float32.
+    '''
+    frame_shape = tuple(video.shape[1:])
+    width = int(np.prod(frame_shape[1:]))
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != frame_shape:
+            raise ValueError('mask has shape %s but frames are %s' % (mask.shape, frame_shape))
+
+    _dcnv() # fail before reading anything if suite2p is missing
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) if use_processes else \
+        ThreadPoolExecutor(max_workers=workers)
+
+    def submit(band):
+        r0, r1 = band
+        if mask is None:
+            pixels = np.arange((r1 - r0) * width)
+        else:
+            pixels = np.flatnonzero(mask[r0:r1])
+        if not len(pixels):
+            return r0, r1, pixels, None
+        batch = np.ascontiguousarray(traces[r0 * width + pixels], dtype=np.float32)
+        return r0, r1, pixels, pool.submit(_deconvolve_batch, batch, tau, fs)
+
+    with pixel_traces(video) as traces, pool:
+        pending = deque()
+        bands = iter(row_bands(video.shape, batch_bytes, align_rows))
+        for band in bands:
+            pending.append(submit(band))
+            if len(pending) >= max_pending:
+                break
+
+        while pending:
+            r0, r1, pixels, future = pending.popleft()
+            spikes = np.zeros((0, len(video)), dtype=np.float32) if future is None else future.result()
+            band = next(bands, None)
+            if band is not None:
+                pending.append(submit(band))
+            yield r0, r1, pixels, spikes
+
+
+def deconvolve_pixels(video, tau=DEFAULT_TAU, fs=DEFAULT_FS, mask=None, out=None, store=None, name=SPIKES, **kwargs):
+    '''
+    Deconvolve a whole session into a N_frames x N_pixels x N_pixels spike array.
+    @Param out: array to write into (ndarray, memmap or HDF5 dataset).  If not given and store is an open store, a chunked
+    dataset called name is created in it, one band of rows per chunk; otherwise a new in-memory array is returned.
+    @Param kwargs: passed to iter_deconvolve_pixels (workers, use_processes, batch_bytes, max_pending).
+    @Return: out.
+    '''
+    if out is None:
+        if store is not None:
+            r0, r1 = row_bands(video.shape, kwargs.get('batch_bytes', BATCH_BYTES))[0]
+            chunks = default_chunks(video.shape)
+            out = create_dataset(store, name, video.shape, np.float32, chunks=(chunks[0], r1 - r0, chunks[2]))
+        else:
+            out = np.zeros(video.shape, dtype=np.float32)
+    chunks = getattr(out, 'chunks', None) # HDF5 datasets: never split a chunk across two bands
+    if chunks:
+        kwargs['align_rows'] = chunks[1]
+
+    n_frames, width = len(video), int(np.prod(video.shape[2:]))
+    for r0, r1, pixels, spikes in iter_deconvolve_pixels(video, tau, fs, mask, **kwargs):
+        band = np.zeros((n_frames, (r1 - r0) * width), dtype=np.float32)
+        band[:, pixels] = spikes.T
+        out[:, r0:r1] = band.reshape((n_frames, r1 - r0) + tuple(video.shape[2:]))
+    return out
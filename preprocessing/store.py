@@ -0,0 +1,197 @@
+'''
+Chunked, compressed on-disk store for pipeline intermediates (replaces median_zscore_dict.pkl, zscore_dict.pkl, etc.).
+
+Everything for one recording goes into a single HDF5 file (widefield.h5 in the recording folder by default):
+
+    video               N_frames x N_pixels x N_pixels            downsampled recording
+    epoched             N_trials x N_frames x N_pixels x N_pixels  epoched trials
+    zscore/<freq>       N_reps x N_frames x N_pixels x N_pixels    z-scored trials, one dataset per frequency
+    median_maps/<freq>  1 x N_pixels x N_pixels                    median z-score map, one dataset per frequency
+    conditions          N_trials x N_columns                       stim_data from the conditions .mat
+    spikes              N_frames x N_pixels x N_pixels            OASIS-deconvolved pixel traces
+
+plus the config_widefield.json values used to make it, stored as metadata.  Datasets are chunked, so a script that only
+needs e.g. a few frequencies, or a patch of pixels, reads just those chunks:
+
+    with open_store(BASE_PATH + STORE_NAME) as store:
+        patch = store[ZSCORE]['12335'][:, :, 100:150, 100:150]
+
+h5py is only needed by the stages that use the store.
+'''
+
+import json
+
+import numpy as np
+
+STORE_NAME = 'widefield.h5'
+
+# dataset / group names
+VIDEO = 'video'
+EPOCHED = 'epoched'
+ZSCORE = 'zscore'
+MEDIAN_MAPS = 'median_maps'
+CONDITIONS = 'conditions'
+SPIKES = 'spikes'
+
+TIME_CHUNK = 32 # frames per chunk along the time / trial axis
+PIXEL_CHUNK = 64 # chunk edge in pixels, so pixel-trace reads and whole-frame reads are both cheap
+
+
+def _h5py():
+    try:
+        import h5py
+    except ImportError as e:
+        raise ImportError('The on-disk store needs h5py (pip install h5py)') from e
+    return h5py
+
+
+def open_store(path, mode='r'):
+    '''
+    Open (or create, with mode='a'/'w') a store.  Use it as a context manager; datasets can be sliced like numpy arrays and
+    only the touched chunks are read.
+    '''
+    return _h5py().File(path, mode)
+
+
+def default_chunks(shape):
+    # keep the two trailing (pixel) axes in square tiles and a modest number of frames / trials per chunk
+    shape = tuple(int(n) for n in shape)
+    if len(shape) < 2:
+        return None
+    leading = tuple(1 for _ in shape[:-3])
+    time_axis = (max(1, min(shape[-3], TIME_CHUNK)),) if len(shape) >= 3 else ()
+    pixels = tuple(max(1, min(n, PIXEL_CHUNK)) for n in shape[-2:])
+    return leading + time_axis + pixels
+
+
+def create_dataset(store, name, shape, dtype, chunks=None, compression='gzip', compression_opts=1, maxshape=None):
+    '''
+    Create (replacing any existing) chunked, compressed dataset.
+    @Param chunks: chunk shape, defaults to default_chunks(shape).
+    @Param maxshape: pass e.g. (None, H, W) to make the first axis growable, for writers that don't know the frame count up front.
+    '''
+    if name in store:
+        del store[name]
+    chunks = chunks or default_chunks(shape)
+    if compression is None:
+        return store.create_dataset(name, shape=tuple(shape), dtype=dtype, chunks=chunks, maxshape=maxshape)
+    return store.create_dataset(name, shape=tuple(shape), dtype=dtype, chunks=chunks, maxshape=maxshape,
+                                compression=compression, compression_opts=compression_opts, shuffle=True)
+
+
+def append_frames(dataset, frames):
+    '''
+    Grow a dataset created with maxshape=(None, ...) along its first axis and write frames at the end.
+    '''
+    start = dataset.shape[0]
+    dataset.resize(start + len(frames), axis=0)
+    dataset[start:] = frames
+    return dataset
+
+
+def write_array(store, name, array, **kwargs):
+    '''
+    Write a whole in-memory array as a chunked dataset.
+    '''
+    array = np.asarray(array)
+    dataset = create_dataset(store, name, array.shape, array.dtype, **kwargs)
+    dataset[...] = array
+    return dataset
+
+
+def write_video(store, source, name=VIDEO, dtype=None, chunk_size=None, **kwargs):
+    '''
+    Stream a FrameSource (or any array) into the store chunk by chunk, so the video never has to be in memory at once.
+    @Param dtype: dataset dtype, defaults to the source's dtype.
+    '''
+    dtype = np.dtype(source.dtype if dtype is None else dtype)
+    dataset = create_dataset(store, name, source.shape, dtype, **kwargs)
+    chunk_size = chunk_size or dataset.chunks[0] * 8
+
+    if hasattr(source, 'iter_chunks'):
+        chunks = source.iter_chunks(chunk_size)
+    else:
+        chunks = ((start, source[start:start + chunk_size]) for start in range(0, len(source), chunk_size))
+
+    for start, chunk in chunks:
+        dataset[start:start + len(chunk)] = chunk.astype(dtype, copy=False)
+    return dataset
+
+
+def write_metadata(store, config=None, **attrs):
+    '''
+    Record the config values (and any other labels) the contents were computed with.  The config dict is stored as JSON so
+    nested values survive; other attributes are stored as plain HDF5 attributes.
+    '''
+    if config is not None:
+        store.attrs['config'] = json.dumps(config)
+    for key, value in attrs.items():
+        store.attrs[key] = value
+
+
+def read_config(store):
+    return json.loads(store.attrs['config']) if 'config' in store.attrs else {}
+
+
+def write_conditions(store, conditions):
+    '''
+    Store the trial conditions (stim_data) so downstream scripts don't need the .mat file.
+    '''
+    return write_array(store, CONDITIONS, np.asarray(conditions), compression=None)
+
+
+def write_condition_arrays(store, name, arrays, **kwargs):
+    '''
+    Write a {frequency: array} dict (median_zscore_dict, zscore_dict, max_dict, ...) as a group with one chunked dataset per
+    frequency.  The keys (ints, floats or strs) and their order are recorded as JSON so the dict can be rebuilt exactly.
+    '''
+    if name in store:
+        del store[name]
+    group = store.create_group(name)
+    keys = list(arrays)
+    group.attrs['keys'] = json.dumps([_plain(key) for key in keys])
+    for key in keys:
+        write_array(group, str(key), np.asarray(arrays[key]), **kwargs)
+    return group
+
+
+def read_condition_arrays(store, name, keys=None, selection=Ellipsis):
+    '''
+    Read back a {frequency: array} dict written by write_condition_arrays.
+    @Param keys: only read these frequencies (default: all, in the original order).
+    @Param selection: index applied to every dataset before reading, e.g. np.s_[:, 5:15] to read just the response frames.
+    Only the chunks covered by the selection are read from disk.
+    '''
+    group = store[name]
+    stored_keys = group.attrs['keys']
+    if isinstance(stored_keys, str):
+        stored_keys = json.loads(stored_keys)
+    else:
+        stored_keys = [_plain(key) for key in stored_keys] # stores written before the keys were JSON: a numeric array
+    keys = stored_keys if keys is None else keys
+    return {_plain(key): group[str(key)][selection] for key in keys}
+
+
+def _plain(key):
+    # numpy scalars (frequencies from stim_data) -> python ints/floats/strs, so they go through JSON and lookups like
+    # d[12335] work as with the pickles
+    return key.item() if hasattr(key, 'item') else key
+
+
+def save_median_maps(path, median_zscore_dict, config=None, conditions=None):
+    '''
+    Save the median z-score maps (what used to go to median_zscore_dict.pkl), with the config used to compute them.
+    '''
+    with open_store(path, 'a') as store:
+        write_condition_arrays(store, MEDIAN_MAPS, median_zscore_dict)
+        write_metadata(store, config)
+        if conditions is not None:
+            write_conditions(store, conditions)
+
+
+def load_median_maps(path, keys=None):
+    '''
+    Load the median z-score maps as a {frequency: map} dict, the same structure as median_zscore_dict.pkl.
+    '''
+    with open_store(path) as store:
+        return read_condition_arrays(store, MEDIAN_MAPS, keys=keys)
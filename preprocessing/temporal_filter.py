@@ -0,0 +1,124 @@
+'''
+Blocked, multi-threaded Butterworth high-pass filtering along the time axis.
+
+apply_butter_highpass called signal.filtfilt on each of the 65k pixel traces in a Python double loop, redesigning the
+filter (butter_highpass) for every pixel.  Here the filter is designed once, in second-order sections (numerically safer
+than b/a coefficients at the low cutoffs used for slow-drift removal), and sosfiltfilt runs along axis 0 on blocks of
+pixel traces at a time.  The blocks are spread over a thread pool - scipy's sosfilt releases the GIL, so they really do
+run in parallel.
+
+The video is processed in chunks of frames, so it never has to be in memory as a whole (it can be a FrameSource, a
+memory-mapped .npy or an HDF5 dataset, and the output can be too).  filtfilt is non-causal, so every chunk is read with
+`margin` extra frames on both sides, filtered, and only the centre is kept.  The margin is the length after which the
+filter's impulse response has decayed below `tol` of its total, so the chunked result matches filtering each whole trace
+to that tolerance; the two ends of the recording are padded exactly as filtfilt pads them.
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+DEFAULT_CUTOFF = 0.2 # Hz
+DEFAULT_ORDER = 5
+DEFAULT_CHUNK_SIZE = 1024 # frames filtered per chunk (plus the margins)
+BLOCK_BYTES = 1 << 21 # aim for ~2 MB of float64 trace data per pixel block, so a block stays in cache
+DEFAULT_TOL = 1e-6
+
+
+@lru_cache(maxsize=None)
+def design_highpass(cutoff, fs, order=DEFAULT_ORDER):
+    '''
+    Butterworth high-pass filter in second-order sections, designed once per (cutoff, fs, order).
+    @Param cutoff: frequency below which activity is filtered out of the signal, in Hz.
+    @Param fs: framerate of the recording in Hz.
+    @Return: sos array (N_sections x 6).
+    '''
+    from scipy import signal
+
+    return signal.butter(order, cutoff, btype='high', fs=fs, output='sos')
+
+
+@lru_cache(maxsize=None)
+def filter_margin(cutoff, fs, order=DEFAULT_ORDER, tol=DEFAULT_TOL):
+    '''
+    Number of frames after which the filter's impulse response has decayed to tol of its total absolute area.  Frames
+    further away than this from a chunk boundary are unaffected (to tol) by where the chunk was cut.
+    '''
+    from scipy import signal
+
+    sos = design_highpass(cutoff, fs, order)
+    n = 256
+    while True:
+        impulse = np.zeros(n)
+        impulse[0] = 1
+        response = np.abs(signal.sosfilt(sos, impulse))
+        tail = np.cumsum(response[::-1])[::-1] # tail[k] = area of the response from k onwards
+        below = np.flatnonzero(tail <= tol * tail[0])
+        if len(below):
+            return int(below[0])
+        n *= 2
+
+
+def _pixel_blocks(n_frames, n_pixels, itemsize=8):
+    block = max(1, BLOCK_BYTES // max(1, n_frames * itemsize))
+    return [(p, min(p + block, n_pixels)) for p in range(0, n_pixels, block)]
+
+
+def _filter_block(sos, frames, out, keep):
+    # frames: N_frames x N_block columns of the chunk, out: the same columns of the output chunk.  The traces are
+    # transposed into contiguous rows first, so the filter runs along the fast axis.
+    from scipy import signal
+
+    traces = np.ascontiguousarray(frames.T, dtype=np.float64)
+    out[:] = signal.sosfiltfilt(sos, traces, axis=-1)[:, keep].T
+
+
+def iter_highpass(video, cutoff=DEFAULT_CUTOFF, fs=10, order=DEFAULT_ORDER, chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+                  dtype=None, tol=DEFAULT_TOL):
+    '''
+    High-pass filter every pixel trace of a video, chunk by chunk.
+    @Param video: N_frames x N_pixels x N_pixels array, memmap, FrameSource or HDF5 dataset.
+    @Param cutoff, fs, order: filter design (cutoff and framerate in Hz).
+    @Param chunk_size: frames per output chunk.  Memory use is about (chunk_size + 2 x margin) x N_pixels x N_pixels x 8 bytes.
+    @Param workers: thread pool size, defaults to the number of cores.
+    @Param dtype: output dtype, defaults to the video's dtype if it is floating point, float32 otherwise.
+    @Return: generator of (first_frame_index, filtered chunk) in frame order.
+    '''
+    sos = design_highpass(cutoff, fs, order)
+    margin = filter_margin(cutoff, fs, order, tol)
+    n_frames = len(video)
+    frame_shape = tuple(video.shape[1:])
+    n_pixels = int(np.prod(frame_shape))
+    if dtype is None:
+        dtype = video.dtype if np.dtype(video.dtype).kind == 'f' else np.float32
+
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, n_frames, chunk_size):
+            stop = min(start + chunk_size, n_frames)
+            lo, hi = max(start - margin, 0), min(stop + margin, n_frames)
+            frames = np.asarray(video[lo:hi]).reshape(hi - lo, n_pixels)
+            keep = slice(start - lo, stop - lo)
+
+            chunk = np.empty((stop - start, n_pixels), dtype=dtype)
+            futures = [pool.submit(_filter_block, sos, frames[:, p0:p1], chunk[:, p0:p1], keep)
+                       for p0, p1 in _pixel_blocks(hi - lo, n_pixels)]
+            for future in futures:
+                future.result()
+            yield start, chunk.reshape((stop - start,) + frame_shape)
+
+
+def highpass_filter(video, cutoff=DEFAULT_CUTOFF, fs=10, order=DEFAULT_ORDER, out=None, **kwargs):
+    '''
+    High-pass filter a whole video (replaces apply_butter_highpass).  The input is never modified.
+    @Param out: optional preallocated N_frames x N_pixels x N_pixels array to write into (e.g. np.lib.format.open_memmap()
+    or an HDF5 dataset), so neither the input nor the output has to fit in RAM.
+    @Return: the filtered video (out, if given).
+    '''
+    for start, chunk in iter_highpass(video, cutoff, fs, order, **kwargs):
+        if out is None:
+            out = np.empty((len(video),) + chunk.shape[1:], dtype=chunk.dtype)
+        out[start:start + len(chunk)] = chunk
+    return out
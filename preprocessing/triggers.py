@@ -0,0 +1,168 @@
+'''
+Stimulus trigger detection, shared by every script.
+
+get_onset_frames used to be copy-pasted into each script and notebook: it walked the trigger CSV one row at a time in
+Python, rounding and comparing every voltage, after np.genfromtxt had already spent most of the time parsing the CSV.
+Here the voltage trace is thresholded in one vectorized pass, and the parsed trace and the detected trigger times are
+cached next to the CSV as a binary sidecar (VoltageRecording_001.csv.npz), keyed by a hash of the CSV's contents.
+Re-running on the same recording skips CSV parsing entirely; editing or replacing the CSV invalidates the cache.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+REFRACTORY_IN_S = 1 # triggers closer together than this are treated as one trigger
+N_START_TRIGGERS = 3 # triggers at the start of the recording that correspond to frame 0, not a stimulus
+SIDECAR_SUFFIX = '.npz'
+
+
+def file_hash(path, block_size=1 << 20):
+    '''
+    Content hash of a file, used to key the sidecar cache.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _parse_csv(csv_path):
+    # np.loadtxt has a fast C parser; fall back to genfromtxt (as the scripts used) if the file has gaps in it
+    try:
+        return np.loadtxt(csv_path, delimiter=',', skiprows=1, ndmin=2)
+    except ValueError:
+        return np.genfromtxt(csv_path, delimiter=',', skip_header=True)
+
+
+def _load_sidecar(csv_path, digest, keys=None):
+    # contents of the sidecar (only the requested keys) if it was made from this exact CSV, otherwise an empty dict
+    sidecar = csv_path + SIDECAR_SUFFIX
+    if not os.path.exists(sidecar):
+        return {}
+    with np.load(sidecar) as cached:
+        if str(cached['hash']) != digest:
+            return {}
+        return {key: cached[key] for key in cached.files if keys is None or key in keys}
+
+
+def _save_sidecar(csv_path, contents):
+    sidecar = csv_path + SIDECAR_SUFFIX
+    try:
+        np.savez(sidecar, **contents)
+    except OSError as e:
+        # read-only data drive etc. - caching is only an optimisation
+        print('Could not write trigger cache ' + sidecar + ': ' + str(e))
+
+
+def read_voltage_recording(csv_path, use_cache=True):
+    '''
+    Load the trigger voltage recording (what np.genfromtxt(csv, delimiter=',', skip_header=True) returned).
+    @Param use_cache: read/write the binary sidecar next to the CSV.
+    @Return: N_samples x N_columns array, column 0 = time in ms, column 1 = voltage.
+    '''
+    if not use_cache:
+        return _parse_csv(csv_path)
+
+    digest = file_hash(csv_path)
+    cached = _load_sidecar(csv_path, digest)
+    if 'stimulus' not in cached:
+        cached = {'hash': digest, 'stimulus': _parse_csv(csv_path)}
+        _save_sidecar(csv_path, cached)
+    return cached['stimulus']
+
+
+def load_trigger_times(csv_path, threshold=None, refractory_in_s=REFRACTORY_IN_S, use_cache=True):
+    '''
+    Trigger times (ms) for a trigger CSV.  The detected times are cached in the sidecar alongside the voltage trace, keyed
+    by the detection parameters, so a re-run neither parses the CSV nor scans the trace.
+    '''
+    if not use_cache:
+        return detect_trigger_times(_parse_csv(csv_path), threshold, refractory_in_s)
+
+    digest = file_hash(csv_path)
+    params = json.dumps({'threshold': threshold, 'refractory_in_s': refractory_in_s})
+    cached = _load_sidecar(csv_path, digest, keys=('trigger_times', 'trigger_params'))
+    if 'trigger_times' in cached and str(cached['trigger_params']) == params:
+        return cached['trigger_times']
+
+    cached = _load_sidecar(csv_path, digest)
+    if 'stimulus' not in cached:
+        cached = {'hash': digest, 'stimulus': _parse_csv(csv_path)}
+    cached['trigger_times'] = detect_trigger_times(cached['stimulus'], threshold, refractory_in_s)
+    cached['trigger_params'] = params
+    _save_sidecar(csv_path, cached)
+    return cached['trigger_times']
+
+
+def detect_trigger_times(stimulus, threshold=None, refractory_in_s=REFRACTORY_IN_S):
+    '''
+    Find the time of every trigger in the voltage trace.
+    @Param stimulus: N_samples x 2 array of (time in ms, voltage).
+    @Param threshold: voltage a sample has to reach to count as a trigger.  By default a sample counts when its rounded
+    voltage equals the rounded maximum voltage, as the old get_onset_frames did.
+    @Param refractory_in_s: a trigger only counts if it starts more than this long after the previous accepted trigger.
+    The window is measured between raw trigger times.  The old get_onset_frames compared each sample against the
+    previous onset with TriggerDelay already added, so its window was effectively refractory + delay; the delay is a
+    shift of every onset and is now only applied afterwards (trigger_times_to_frames).  With TriggerDelay = 0, the
+    default, the two agree.
+    @Return: 1D array of trigger times in ms.
+    '''
+    times, voltage = stimulus[:, 0], stimulus[:, 1]
+    if len(voltage) == 0:
+        return np.empty(0)
+
+    if threshold is None:
+        high = np.round(voltage) == np.round(np.nanmax(voltage))
+    else:
+        high = voltage >= threshold
+
+    # rising edges: samples that are high when the previous sample wasn't
+    edges = np.flatnonzero(high & ~np.concatenate(([False], high[:-1])))
+    edge_times = times[edges]
+
+    # The refractory window depends on the last *accepted* trigger, so it's applied sequentially, but only over the
+    # handful of edges (one per trial), not over every sample of the recording.
+    refractory_in_ms = refractory_in_s * 1000
+    keep = np.zeros(len(edge_times), dtype=bool)
+    last = -np.inf
+    for i, t in enumerate(edge_times):
+        if t - last > refractory_in_ms:
+            keep[i] = True
+            last = t
+    return edge_times[keep]
+
+
+def trigger_times_to_frames(trigger_times, trigger_delay_in_ms=0, recording_framerate=10, n_start_triggers=N_START_TRIGGERS):
+    onset_times_in_s = (np.asarray(trigger_times) + trigger_delay_in_ms) / 1000
+    onset_frames_at_recording_fr = onset_times_in_s * recording_framerate # s * f/s = f
+    # drop the triggers at the start of the recording
+    return onset_frames_at_recording_fr[n_start_triggers:]
+
+
+def get_onset_frames(stimulus, trigger_delay_in_ms=0, recording_framerate=10, n_start_triggers=N_START_TRIGGERS,
+                     threshold=None, refractory_in_s=REFRACTORY_IN_S):
+    '''
+    Find the stimulus onsets from the trigger voltage trace and define them as frames in the fluorescence recording.
+    @Param stimulus: N_samples x 2 array of (time in ms, voltage), e.g. from read_voltage_recording.
+    @Param trigger_delay_in_ms: delay between TDT sending a trigger and the stimulus actually happening (config 'TriggerDelay').
+    @Param recording_framerate: framerate of the fluorescence recording (config 'RecordingFR').
+    @Param n_start_triggers: number of leading triggers to drop (the first three correspond to the start at frame zero).
+    @Param refractory_in_s: minimum gap between raw trigger times, not including the trigger delay (see detect_trigger_times).
+    @Return onset_frames_at_recording_fr: array of the (fractional) frames in the fluo recording where the stim was presented.
+    '''
+    trigger_times = detect_trigger_times(stimulus, threshold, refractory_in_s)
+    return trigger_times_to_frames(trigger_times, trigger_delay_in_ms, recording_framerate, n_start_triggers)
+
+
+def load_onset_frames(csv_path, config, use_cache=True, n_start_triggers=N_START_TRIGGERS, threshold=None,
+                      refractory_in_s=REFRACTORY_IN_S):
+    '''
+    Onset frames straight from the trigger CSV, through the sidecar cache, using the TriggerDelay and RecordingFR values
+    from config_widefield.json.
+    '''
+    trigger_times = load_trigger_times(csv_path, threshold, refractory_in_s, use_cache=use_cache)
+    return trigger_times_to_frames(trigger_times, config['TriggerDelay'], config['RecordingFR'], n_start_triggers)
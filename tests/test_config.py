@@ -0,0 +1,26 @@
+import json
+
+import numpy as np
+
+from preprocessing.config import DEFAULTS, get_config
+from preprocessing.frame_source import open_recording
+from functional_analysis.plot_tonotopic_map import load_recording
+
+
+def test_get_config_fills_defaults_into_passed_config():
+    config = get_config({'RecordingFR': 10, 'DownsampleFactor': 4})
+    assert config['DownsampleFactor'] == 4
+    assert config['DownsampleDtype'] == DEFAULTS['DownsampleDtype']
+    assert config['RecordingFR'] == 10
+
+
+def test_legacy_load_recording_with_an_older_config(tmp_path):
+    import tifffile
+
+    frames = np.arange(3 * 8 * 8, dtype=np.uint16).reshape(3, 8, 8)
+    tifffile.imwrite(str(tmp_path / 'rec.tif'), frames, photometric='minisblack')
+    (tmp_path / 'config.json').write_text(json.dumps({'RecordingFR': 10}))
+
+    video = load_recording(str(tmp_path / 'rec.tif'), json.loads((tmp_path / 'config.json').read_text()))
+    assert video.shape == (3, 4, 4)
+    np.testing.assert_array_equal(video[:], open_recording(str(tmp_path / 'rec.tif'), downsample=2)[:])
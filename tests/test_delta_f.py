@@ -0,0 +1,45 @@
+import numpy as np
+
+from preprocessing import delta_f
+from preprocessing.frame_source import FrameSource, pixel_traces
+
+
+class ArraySource(FrameSource):
+    '''
+    FrameSource over an in-memory array that records every _read.
+    '''
+
+    def __init__(self, frames):
+        super().__init__(len(frames), frames.shape[1:], frames.dtype)
+        self.frames = frames
+        self.reads = []
+
+    def _read(self, start, stop):
+        self.reads.append((start, stop))
+        return self.frames[start:stop]
+
+
+def make_video(n_frames=300, height=16, width=12):
+    rng = np.random.default_rng(0)
+    return (rng.random((n_frames, height, width)) * 1000 + 100).astype(np.float32)
+
+
+def test_percentile_f0_reads_each_frame_once(monkeypatch):
+    frames = make_video()
+    source = ArraySource(frames)
+    monkeypatch.setattr(delta_f, 'BAND_BYTES', len(frames) * 8 * 10) # 10 pixels per band -> 20 bands
+
+    f0 = delta_f.compute_f0(source, 'percentile', percentile=10, chunk_size=64)
+
+    assert source.reads == [(0, 64), (64, 128), (128, 192), (192, 256), (256, 300)]
+    np.testing.assert_array_equal(f0, np.percentile(frames, 10, axis=0))
+
+
+def test_pixel_traces_memmap_matches_in_memory():
+    frames = make_video()
+    with pixel_traces(frames, chunk_size=50) as in_memory:
+        expected = np.array(in_memory)
+    with pixel_traces(frames, chunk_size=50, max_memory_bytes=0) as traces:
+        assert isinstance(traces, np.memmap)
+        np.testing.assert_array_equal(traces, expected)
+    np.testing.assert_array_equal(expected, frames.reshape(len(frames), -1).T)
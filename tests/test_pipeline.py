@@ -0,0 +1,51 @@
+from collections import Counter
+
+from functional_analysis.pipeline import Pipeline, Stage
+
+
+def make_stages(calls):
+    def stage(name):
+        def func(config, *inputs):
+            calls[name] += 1
+            return [name] + list(inputs)
+        return func
+
+    return [
+        Stage('load', (), ('TIFF',), stage('load'), cache=False),
+        Stage('zscore', ('load',), ('BaselineFrames',), stage('zscore')),
+        Stage('median', ('zscore',), (), stage('median')),
+        Stage('threshold', ('median',), ('ZscoreThreshold',), stage('threshold')),
+        Stage('best_frequency', ('threshold',), (), stage('best_frequency')),
+        Stage('plot', ('threshold', 'best_frequency'), (), stage('plot'), cache=False),
+    ]
+
+
+def run(tmp_path, force=(), **config):
+    calls = Counter()
+    config = {'RecordingFolder': str(tmp_path), 'TIFF': 'rec.tif', 'BaselineFrames': 5, 'ZscoreThreshold': 1, **config}
+    pipeline = Pipeline(config, make_stages(calls), cache_dir=str(tmp_path / 'cache'))
+    pipeline.run('plot', force=force)
+    return calls, {run.name: run.status for run in pipeline.runs}
+
+
+def test_second_run_is_cached(tmp_path):
+    run(tmp_path)
+    calls, status = run(tmp_path)
+    assert status == {'threshold': 'cached', 'best_frequency': 'cached', 'plot': 'ran'}
+    assert set(calls) == {'plot'}
+
+
+def test_force_upstream_recomputes_cached_downstream(tmp_path):
+    run(tmp_path)
+    run(tmp_path, ZscoreThreshold=2)
+    calls, status = run(tmp_path, force={'zscore'}, ZscoreThreshold=2)
+    assert status == {'load': 'ran', 'zscore': 'ran', 'median': 'ran', 'threshold': 'ran', 'best_frequency': 'ran',
+                      'plot': 'ran'}
+    assert all(count == 1 for count in calls.values())
+
+
+def test_force_leaves_other_branches_cached(tmp_path):
+    run(tmp_path)
+    calls, status = run(tmp_path, force={'best_frequency'})
+    assert status == {'threshold': 'cached', 'best_frequency': 'ran', 'plot': 'ran'}
+    assert set(calls) == {'best_frequency', 'plot'}
@@ -0,0 +1,46 @@
+import types
+
+import h5py
+import numpy as np
+
+from preprocessing import spike_deconvolution
+from preprocessing.frame_source import FrameSource
+from preprocessing.store import SPIKES
+
+
+class ArraySource(FrameSource):
+    def __init__(self, frames):
+        super().__init__(len(frames), frames.shape[1:], frames.dtype)
+        self.frames = frames
+        self.reads = []
+
+    def _read(self, start, stop):
+        self.reads.append((start, stop))
+        return self.frames[start:stop]
+
+
+def fake_oasis(F, batch_size, tau, fs):
+    return 2 * F
+
+
+def test_deconvolve_pixels_reads_once_and_writes_whole_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(spike_deconvolution, '_dcnv', lambda: types.SimpleNamespace(oasis=fake_oasis))
+    rng = np.random.default_rng(0)
+    frames = rng.random((300, 40, 24)).astype(np.float32)
+    source = ArraySource(frames)
+    mask = rng.random((40, 24)) > 0.3
+    batch_bytes = len(frames) * 24 * 4 * 6 # 6 rows per band
+
+    with h5py.File(str(tmp_path / 'widefield.h5'), 'w') as store:
+        spikes = spike_deconvolution.deconvolve_pixels(source, mask=mask, store=store, use_processes=False, workers=2,
+                                                       batch_bytes=batch_bytes)
+        assert spikes.chunks[1] == 6
+        result = store[SPIKES][:]
+
+    assert source.reads == [(0, 256), (256, 300)]
+    np.testing.assert_array_equal(result, np.where(mask, 2 * frames, 0))
+
+
+def test_row_bands_align_to_chunk_rows():
+    assert spike_deconvolution.row_bands((100, 10, 8), batch_bytes=100 * 8 * 4 * 3, align=4) == [(0, 4), (4, 8), (8, 10)]
+    assert spike_deconvolution.row_bands((100, 10, 8), batch_bytes=100 * 8 * 4 * 9, align=4) == [(0, 8), (8, 10)]
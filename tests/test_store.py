@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from preprocessing.store import open_store, read_condition_arrays, write_condition_arrays
+
+
+@pytest.mark.parametrize('keys', [['12335', '4000', 'silent'], [np.int64(12335), np.int64(4000)], [5.5, 2.25]])
+def test_condition_arrays_round_trip(tmp_path, keys):
+    arrays = {key: np.full((1, 4, 4), i, dtype=np.float32) for i, key in enumerate(keys)}
+    path = str(tmp_path / 'widefield.h5')
+    with open_store(path, 'a') as store:
+        write_condition_arrays(store, 'median_maps', arrays)
+    with open_store(path) as store:
+        loaded = read_condition_arrays(store, 'median_maps')
+        patch = read_condition_arrays(store, 'median_maps', keys=[keys[1]], selection=np.s_[:, 1:3, 1:3])
+
+    expected = [key.item() if hasattr(key, 'item') else key for key in keys]
+    assert list(loaded) == expected
+    assert [type(key) for key in loaded] == [type(key) for key in expected]
+    for key, value in arrays.items():
+        np.testing.assert_array_equal(loaded[key], value)
+    np.testing.assert_array_equal(patch[keys[1]], np.ones((1, 2, 2)))
+
+
+def test_reads_numeric_keys_of_older_stores(tmp_path):
+    path = str(tmp_path / 'widefield.h5')
+    with open_store(path, 'a') as store:
+        write_condition_arrays(store, 'median_maps', {4000: np.zeros((1, 2, 2)), 12335: np.ones((1, 2, 2))})
+        store['median_maps'].attrs['keys'] = np.array([4000, 12335])
+    with open_store(path) as store:
+        loaded = read_condition_arrays(store, 'median_maps')
+    assert list(loaded) == [4000, 12335] and type(list(loaded)[0]) is int